@@ -10,6 +10,7 @@ import xmltodict
 from data.E2E.rephrasing import rephrase, rephrase_if_must
 from data.reader import DataReader, DataSetType, Datum
 from utils.delex import concat_entity
+from utils.plan_codec import decode
 from utils.tokens import tokenize
 
 DONT_DELEX = {"priceRange", "familyFriendly", "customer rating"}
@@ -71,7 +72,7 @@ class E2EDataReader(DataReader):
         plan_sentences = defaultdict(list)
         for d in self.data:
             meta = self.get_meta(d)
-            plan = d.plan.replace(concat_entity(meta["name"]), concat_entity("name"))
+            plan = decode(d.plan).replace(concat_entity(meta["name"]), concat_entity("name"))
             delex = d.delex
             if delex:
                 ents = [meta["name"]] + [o for s, r, o in d.rdfs if r not in DONT_DELEX]
@@ -1,10 +1,9 @@
 import multiprocessing
 import pickle
 import re
-import zlib
 from collections import defaultdict, Counter
 from enum import Enum
-from itertools import chain
+from itertools import chain, islice
 from multiprocessing.pool import Pool
 from typing import List, Tuple, Dict, Callable
 
@@ -15,10 +14,13 @@ import time
 from eval.bleu.eval import BLEU, naive_tokenizer
 from model.model_runner import Model
 from reg.base import REG
-from utils.aligner import entities_order, SENTENCE_BREAK, comp_order
+from utils.aligner import entities_order, SENTENCE_BREAK, order_step
+from utils.compressed_plans import CompressedPlans
 from utils.delex import Delexicalize, concat_entity
-from utils.graph import Graph
+from utils.graph import Graph, GraphRegistry, PlanCache, fill_slots, plan_choices, push_frames, stack_bounds
 from utils.out_of import out_of
+from utils.plan_codec import PLAN_VOCABULARY, encode, decode
+from utils.plan_store import PlanStore, ranked_ids
 from utils.relex import get_entities
 from utils.tokens import SPLITABLES, tokenize, tokenize_sentences
 
@@ -81,15 +83,38 @@ class Datum:
         return self
 
 
-def exhaustive_plan(g: Graph, planner):
-    plans = list(planner.plan_all(g))
-    scores = planner.scores([(g, p) for p in plans])
-    p_scores = {p: scores[i] for i, p in enumerate(plans)}
-    return sorted(plans, key=lambda p: p_scores[p], reverse=True)
+def exhaustive_plan(g: Graph, planner, batch_size=10000):
+    if planner.is_parallel and planner.workers > 1 and planner.budget is None:
+        return planner.plan_top_parallel(g, batch_size=batch_size)
 
+    plans = planner.plan_iter(g)
+    plan_scores = []
+    while True:
+        batch = list(islice(plans, batch_size))
+        if len(batch) == 0:
+            break
+        plan_scores += zip(batch, planner.scores([(g, p) for p in batch]))
 
-def compress_plans(plans: List[str]) -> str:
-    return zlib.compress("\n".join(plans).encode("utf-8"))
+    return [p for p, s in sorted(plan_scores, key=lambda a: a[1], reverse=True)]
+
+
+def planned_count(g: Graph, planner):
+    # The best plans, and the size of the plan space. Planning out of budget did not build the plan space,
+    # and counting it would build it after the budget ran out, so its size is left unknown.
+    best = planner.plan_best(g)
+    if len(getattr(best, "degraded", [])) > 0:
+        return best, None
+    return best, planner.plan_count(g)
+
+
+def fill_template(plans, slots):
+    if isinstance(plans, list):
+        return [fill_slots(p, slots) for p in plans]
+    return fill_slots(plans, slots)
+
+
+def compress_plans(plans: List[str]) -> CompressedPlans:
+    return CompressedPlans(plans)
 
 
 def exhaustive_plan_compress(input):
@@ -97,6 +122,16 @@ def exhaustive_plan_compress(input):
     return compress_plans(exhaustive_plan(g, planner))
 
 
+def stored_plans(store: PlanStore, g: Graph, planner, slots=None):
+    # Ranked plans from the store, ranking and storing them first if the graph is not there
+    if g in store:
+        return store.get(g, slots)
+
+    structure = planner.plan_structure(g)
+    ids = ranked_ids(structure, lambda batch: planner.scores([(g, p) for p in batch]))
+    return store.put(g, structure, ids, slots)
+
+
 def match_plan(d: Datum):
     g = d.graph
     s = d.delex
@@ -118,22 +153,49 @@ def match_plan(d: Datum):
         })
 
     nodes = tuple(map(concat_entity, g.nodes))
+    s_order = [e for e, i in entities_order(SENTENCE_BREAK.join(s_s), nodes)]
 
-    possible_plans = g.constraint_graphs_plan(components).linearizations()
-    final_plans = []
-
-    for p in possible_plans:
-        p_s = p.split(".")
-
-        s_order = entities_order(SENTENCE_BREAK.join(s_s), nodes)
-        p_order = entities_order(SENTENCE_BREAK.join(p_s), nodes)
-
-        if comp_order([e for e, i in s_order], [e for e, i in p_order]):
-            final_plans.append(p)
-
-    if len(final_plans) == 0:
+    plan = ordered_plan(g.constraint_graphs_plan(components), s_order, nodes)
+    if plan is None:
         return []
-    return [max(final_plans, key=lambda p: len(list(filter(lambda w: w == ">", p.split()))))]
+    return [plan]
+
+
+def ordered_plan(structure, ref, nodes):
+    # Depth first search over the partial plans, reading their entities order against the reference as they grow.
+    # Returns the plan following the reference order with the most ">", bounding the ">" any completion can add.
+    def piece_bound(piece):
+        return 0, piece.split().count(">")
+
+    bounds_cache = {}
+    best = [-1, None]
+
+    def search(stack, i, directions, pieces):
+        new_pieces, options = plan_choices(stack)
+        for piece in new_pieces:
+            for e, _ in entities_order(SENTENCE_BREAK.join(piece.split(".")), nodes):
+                i = order_step(ref, i, e)
+                if i is None:
+                    return
+            directions += piece.split().count(">")
+            pieces = (piece, pieces)
+
+        for option in options:
+            if option is None:
+                if i == len(ref) and directions > best[0]:
+                    plan, rest = [], pieces
+                    while rest is not None:
+                        piece, rest = rest
+                        plan.append(piece)
+                    best[:] = [directions, "".join(reversed(plan))]
+                continue
+
+            bounds = stack_bounds(option, piece_bound, bounds_cache)
+            if bounds is not None and directions + bounds[2] > best[0]:
+                search(option, i, directions, pieces)
+
+    search(push_frames(None, [structure]), 0, 0, None)
+    return best[1]
 
 
 class DataReader:
@@ -150,12 +212,15 @@ class DataReader:
         self.delex = Delexicalize(rephrase_f=self.rephrase[0], rephrase_if_must_f=self.rephrase[1])
 
         self.timing = {}
+        self.plan_space = {}
+        self.degraded = {}  # Number of graphs, per size, planned with a degraded strategy
 
     def copy(self):
         return pickle.loads(pickle.dumps(self))
 
     def generate_graphs(self):
-        self.data = [d.set_graph(Graph(d.rdfs)) for d in self.data]
+        graphs = GraphRegistry()
+        self.data = [d.set_graph(graphs.get(d.rdfs)) for d in self.data]
         return self
 
     def fix_spelling(self):
@@ -187,43 +252,83 @@ class DataReader:
         self.data = [d.set_plan(p) for d, plans in zip(self.data, plans) for p in plans]
         return self
 
-    def exhaustive_plan(self, planner):
-        unique = {d.graph.unique_key(): d.graph for d in self.data}
-        unique_graphs = list(reversed(list(unique.values())))
+    def exhaustive_plan(self, planner, store: PlanStore = None):
+        unique_graphs = list(reversed(list(dict.fromkeys(d.graph for d in self.data))))
 
+        # Graphs sharing triples share their sub-plans
+        planner.plan_cache = PlanCache()
         plan_iter = ((g, planner) for g in unique_graphs)
 
         # pool = Pool(multiprocessing.cpu_count() - 1)
         # plans = list(tqdm(pool.imap(exhaustive_plan_compress, plan_iter),
         #                   total=len(unique_graphs)))
-        plans = [exhaustive_plan_compress(g_p) for g_p in tqdm(list(plan_iter))]
-
-        graph_plans = {g.unique_key(): p for g, p in zip(unique_graphs, plans)}
-        self.data = [d.set_plans(graph_plans[d.graph.unique_key()]) for d in self.data]
+        if store is not None:
+            # Plans are read from the store, and only graphs missing from it are planned
+            if planner.entity_agnostic:
+                plans = [stored_plans(store, template_g, planner, slots)
+                         for template_g, slots in tqdm([g.canonical() for g in unique_graphs])]
+            else:
+                plans = [stored_plans(store, g, planner) for g in tqdm(unique_graphs)]
+            if store.writable:
+                store.flush()
+        elif planner.entity_agnostic:
+            # Every graph shape is planned once, on its canonical graph
+            canonical = [g.canonical() for g in unique_graphs]
+            templates = {}
+            for template_g, slots in tqdm(canonical):
+                if template_g not in templates:
+                    templates[template_g] = exhaustive_plan(template_g, planner)
+            plans = [compress_plans(fill_template(templates[template_g], slots))
+                     for template_g, slots in canonical]
+        else:
+            plans = [exhaustive_plan_compress(g_p) for g_p in tqdm(list(plan_iter))]
+        planner.plan_cache = None
+
+        graph_plans = dict(zip(unique_graphs, plans))
+        self.data = [d.set_plans(graph_plans[d.graph]) for d in self.data]
         return self
 
     def create_plans(self, planner):
         assert planner is not None
 
-        unique = {d.graph.unique_key(): d.graph for d in self.data}
-        unique_graphs = list(reversed(list(unique.values())))
+        unique_graphs = list(reversed(list(dict.fromkeys(d.graph for d in self.data))))
 
         # if planner.is_parallel:
         #     pool = Pool(multiprocessing.cpu_count() - 1)
         #     plans = list(tqdm(pool.imap(planner.plan_best, unique_graphs), total=len(unique_graphs)))
         # else:
+        planner.plan_cache = PlanCache()
+        templates = {}
         plans = []
         for g in tqdm(unique_graphs):
             start = time.time()
-            plans.append(planner.plan_best(g))
+            if planner.entity_agnostic:
+                # Every graph shape is planned once, on its canonical graph
+                template_g, slots = g.canonical()
+                if template_g not in templates:
+                    templates[template_g] = planned_count(template_g, planner)
+                template, plan_count = templates[template_g]
+                plans.append(fill_template(template, slots))
+                degraded = getattr(template, "degraded", [])
+            else:
+                best, plan_count = planned_count(g, planner)
+                plans.append(best)
+                degraded = getattr(best, "degraded", [])
             g_size = len(g.edges)
+            if len(degraded) > 0:
+                self.degraded[g_size] = self.degraded.get(g_size, 0) + 1
             if g_size not in self.timing:
                 self.timing[g_size] = []
             self.timing[g_size].append(time.time() - start)
+            if plan_count is not None:
+                if g_size not in self.plan_space:
+                    self.plan_space[g_size] = []
+                self.plan_space[g_size].append(plan_count)
+        planner.plan_cache = None
 
-        graph_plan = {g.unique_key(): p for g, p in zip(unique_graphs, plans)}
+        graph_plan = dict(zip(unique_graphs, plans))
         for d in self.data:
-            plans = graph_plan[d.graph.unique_key()]
+            plans = graph_plan[d.graph]
             if isinstance(plans, list):
                 d.set_plan(plans[0])
                 d.set_plans(plans[1:])
@@ -239,13 +344,21 @@ class DataReader:
         self.data = [d.set_delex(" ".join(tokenize(d.delex))) for d in self.data]
         return self
 
+    def encode_plans(self, vocab=PLAN_VOCABULARY):
+        # Plans are kept as token ids from here on, and only decoded to be translated
+        for d in self.data:
+            d.set_plan(encode(d.plan, vocab))
+            if isinstance(d.plans, list):
+                d.set_plans([encode(p, vocab) for p in d.plans])
+        return self
+
     def report(self):
         return "Length " + str(len(self.data))
 
     def for_translation(self):
         plan_sentences = defaultdict(list)
         for d in self.data:
-            plan_sentences[d.plan].append(d.delex)
+            plan_sentences[decode(d.plan)].append(d.delex)
 
         return plan_sentences
 
@@ -255,7 +368,7 @@ class DataReader:
         fallback = {}
 
         for _ in range(50):
-            plans = [d.plan for d in data]
+            plans = [decode(d.plan) for d in data]
 
             translations = model.translate(plans, opts)
 
@@ -264,9 +377,8 @@ class DataReader:
                 if is_covered_order:
                     d.set_hyp(t)
 
-                graph_key = d.graph.unique_key()
-                if not (graph_key in fallback) or (is_covered_ent and not fallback[graph_key][2]):
-                    fallback[graph_key] = (p, t, is_covered_ent)
+                if not (d.graph in fallback) or (is_covered_ent and not fallback[d.graph][2]):
+                    fallback[d.graph] = (p, t, is_covered_ent)
 
             data = list(filter(lambda d: d.hyp is None, data))
             if len(data) == 0:
@@ -279,15 +391,14 @@ class DataReader:
                         d.set_plans(plans[1:])
                         d.set_plan(plans[0])
             else:
-                unique_graphs = {d.graph.unique_key(): d.graph for d in data}
-                graph_plans = {k: planner.plan_random(g, 1)[0] for k, g in unique_graphs.items()}
+                graph_plans = {g: planner.plan_random(g, 1)[0] for g in dict.fromkeys(d.graph for d in data)}
                 for d in data:
-                    d.set_plan(graph_plans[d.graph.unique_key()])
+                    d.set_plan(graph_plans[d.graph])
 
             self.coverage()
 
         for d in data:
-            plan, hyp, _ = fallback[d.graph.unique_key()]
+            plan, hyp, _ = fallback[d.graph]
             d.set_plan(plan).set_hyp(hyp)
 
         return self
@@ -312,8 +423,8 @@ class DataReader:
         plan_ref = defaultdict(list)
         plan_hyp = {}
         for d in self.data:
-            plan_ref[d.plan].append(d.text)
-            plan_hyp[d.plan] = d.hyp
+            plan_ref[decode(d.plan)].append(d.text)
+            plan_hyp[decode(d.plan)] = d.hyp
 
         hypothesis = [plan_hyp[p] for p in plan_ref.keys()]
         references = list(plan_ref.values())
@@ -345,7 +456,7 @@ class DataReader:
     def coverage(self):
         pairs = {"seen": {}, "unseen": {}}
         for d in self.data:
-            pairs["seen" if d.info["seen"] else "unseen"][d.plan] = d.hyp
+            pairs["seen" if d.info["seen"] else "unseen"][decode(d.plan)] = d.hyp
 
         coverage = {}
         for t, v in pairs.items():
@@ -367,7 +478,7 @@ class DataReader:
     def retries(self):
         pairs = {"seen": {}, "unseen": {}}
         for d in self.data:
-            pairs["seen" if d.info["seen"] else "unseen"][d.plan] = d.plan_changes - 1 if hasattr(d,
+            pairs["seen" if d.info["seen"] else "unseen"][decode(d.plan)] = d.plan_changes - 1 if hasattr(d,
                                                                                                   "plan_changes") else 1
 
         sums = {k: np.average(list(v.values())) for k, v in pairs.items()}
@@ -378,7 +489,7 @@ class DataReader:
         graphs = {}
         for d in self.data:
             if "manual" in d.info and d.info["manual"]:
-                graphs[d.graph.unique_key()] = {
+                graphs[d.graph] = {
                     "id": d.info["id"] if hasattr(d.info, "id") else None,
                     "sen": d.hyp,
                     "rdf": [(r, d, f, None) for r, d, f in d.graph.as_rdf()],
@@ -391,4 +502,4 @@ class DataReader:
         return self
 
     def export(self):
-        return [{"rdf": d.graph.as_rdf(), "text": d.text, "delex": d.delex, "plan": d.plan, "hyp": d.hyp} for d in self.data]
+        return [{"rdf": d.graph.as_rdf(), "text": d.text, "delex": d.delex, "plan": decode(d.plan), "hyp": d.hyp} for d in self.data]
@@ -2,16 +2,16 @@ from functools import lru_cache
 from typing import List, Dict
 
 from eval.bleu.eval import BLEU, naive_tokenizer
+from utils.plan import Plan
+from utils.plan_codec import decode
 
 
 @lru_cache(maxsize=None)
 def add_features(plan: str):
     # return plan
-    paren = {"[", "]"}
-    dir = {"<", ">"}
-    words = plan.split(" ")
-    features = ["S" if w in paren else ("D" if w in dir else ("E" if w[:4] == "ENT_" else "R")) for w in words]
-    return " ".join([w + "\uFFE8" + f for w, f in zip(words, features)])  # Special Character!
+    if not isinstance(plan, Plan):
+        plan = Plan(decode(plan))
+    return " ".join([w + "\uFFE8" + f for w, f in zip(plan.words, plan.tags)])  # Special Character!
 
 
 def spread_translation_dict(for_translation):
@@ -2,13 +2,14 @@ import numpy as np
 from data.reader import DataReader
 from planner.planner import Planner
 from scorer.scorer import Scorer
-from utils.graph import Graph
+from utils.graph import Graph, PlanCache
 from typing import Callable, Tuple, List
 
 
 class CombinedPlanner(Planner):
-    def __init__(self, planners: Tuple[Planner, Planner]):
+    def __init__(self, planners: Tuple[Planner, Planner], budget=None):
         self.planners = planners
+        self.budget = budget
 
     def learn(self, train_reader: DataReader, dev_reader: DataReader):
         self.planners = [p.learn(train_reader, dev_reader) for p in self.planners]
@@ -20,6 +21,26 @@ class CombinedPlanner(Planner):
 
         ranker, re_ranker = self.planners
 
-        ranker_plans = ranker.plan_random(g, 50) + [ranker.plan_best(g)]
+        if self.budget is None:
+            ranker_plans = ranker.plan_random(g, 50) + [ranker.plan_best(g)]
+            return re_ranker.plan_best(g, ranker_plans=ranker_plans)
 
-        return re_ranker.plan_best(g, ranker_plans=ranker_plans)
+        # The ranker plans under this budget, and keeps the plan structure it builds, so sampling from it again
+        # does not build it again
+        ranker_budget, ranker_cache = ranker.budget, ranker.plan_cache
+        ranker.budget, ranker.plan_cache = self.budget, ranker_cache or PlanCache()
+        try:
+            self.budget.start()
+            best = ranker.plan_best(g)
+            ranker_plans = [best]
+            for _ in range(50):
+                reason = self.budget.exhausted()
+                if reason:
+                    # Re-ranking only a few sampled plans is not worth it, the greedy plan is used as is
+                    self.budget.degrade(reason, "greedy plan")
+                    return self.budgeted([best])
+                ranker_plans += ranker.plan_random(g, 1)
+        finally:
+            ranker.budget, ranker.plan_cache = ranker_budget, ranker_cache
+
+        return self.budgeted(re_ranker.plan_best(g, ranker_plans=ranker_plans))
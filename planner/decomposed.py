@@ -0,0 +1,93 @@
+import random
+
+from data.reader import DataReader
+from planner.planner import Planner
+from utils.graph import Graph, StructuredNode, NodeType, fill_slots
+
+
+class DecomposedPlanner(Planner):
+    # Plans graphs too large for exhaustive planning a part at a time. A graph is split to biconnected blocks of up
+    # to max_size edges, every part is planned by the given planner, and the parts' sentences are stitched greedily:
+    # the next part is the one continuing the plan with the best score, out of the parts sharing an entity with it.
+    # Smaller graphs are planned by the given planner as is.
+    re_plan = True  # Large graphs have a single best plan, so other plans are sampled
+
+    def __init__(self, planner: Planner, max_size=4):
+        self.planner = planner
+        self.max_size = max_size
+        self.templates = {}  # Best plan of every canonical part, for entity agnostic planners
+
+    def learn(self, train_reader: DataReader, dev_reader: DataReader):
+        self.planner = self.planner.learn(train_reader, dev_reader)
+        self.templates = {}
+        return self
+
+    def score(self, g: Graph, plan: str):
+        return self.planner.score(g, plan)
+
+    def scores(self, batch):
+        return self.planner.scores(batch)
+
+    @property
+    def log_scored(self):
+        return self.planner.log_scored
+
+    def is_large(self, g: Graph):
+        return len(g.as_rdf()) > self.max_size
+
+    def plan_part(self, g: Graph):
+        self.planner.plan_cache = self.plan_cache
+        if not self.planner.entity_agnostic:
+            plans = self.planner.plan_best(g)
+            return plans[0] if isinstance(plans, list) else plans
+
+        # Parts of the same shape are planned once
+        template_g, slots = g.canonical()
+        if template_g not in self.templates:
+            plans = self.planner.plan_best(template_g)
+            self.templates[template_g] = plans[0] if isinstance(plans, list) else plans
+        return fill_slots(self.templates[template_g], slots)
+
+    def stitch(self, g: Graph, parts, plans):
+        remaining = list(range(len(parts)))
+        plan = None
+        nodes = set()
+        while len(remaining) > 0:
+            candidates = [i for i in remaining if parts[i].nodes & nodes] or remaining
+            options = [plans[i] if plan is None else plan + ". " + plans[i] for i in candidates]
+            scores = self.planner.scores([(g, p) for p in options])
+            best = max(range(len(candidates)), key=lambda j: scores[j])
+
+            plan = options[best]
+            nodes |= parts[candidates[best]].nodes
+            remaining.remove(candidates[best])
+        return plan
+
+    def plan_best(self, g: Graph, ranker_plans=None):
+        if ranker_plans or not self.is_large(g):
+            self.planner.plan_cache = self.plan_cache
+            return self.planner.plan_best(g, ranker_plans=ranker_plans)
+
+        parts = g.decompose(self.max_size)
+        return self.stitch(g, parts, [self.plan_part(p) for p in parts])
+
+    def plan_structure(self, g: Graph):
+        self.planner.plan_cache = self.plan_cache
+        if not self.is_large(g):
+            return self.planner.plan_structure(g)
+
+        # The plans of every part, with the parts in the graph's order
+        return StructuredNode(NodeType.SENTENCES, [("", self.planner.plan_structure(p))
+                                                  for p in g.decompose(self.max_size)])
+
+    def plan_random(self, g: Graph, amount: int):
+        if not self.is_large(g):
+            return self.planner.plan_random(g, amount)
+
+        parts = g.decompose(self.max_size)
+        plans = []
+        for _ in range(amount):
+            sentences = [self.planner.plan_random(p, 1)[0] for p in parts]
+            random.shuffle(sentences)
+            plans.append(". ".join(sentences))
+        return plans
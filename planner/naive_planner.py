@@ -1,20 +1,31 @@
+from heapq import heappush, heappop
+from itertools import count
+
 import numpy as np
 from tqdm import tqdm
 
 from data.reader import DataReader
-from planner.planner import Planner
+from planner.planner import Planner, top_plans
 from scorer.scorer import Scorer
-from utils.graph import Graph
+from utils.graph import Graph, plan_choices, push_frames, stack_bounds
 
 
 class NaivePlanner(Planner):
     is_parallel = True
     re_plan = "PREMADE"
+    best_first = False
+    entity_agnostic = True
+    batch_size = 256  # Plans scored together. Larger batches score a little faster, but hold many more plans
+    log_scored = True
 
-    def __init__(self, scorer: Scorer):
+    def __init__(self, scorer: Scorer, best_first=False, budget=None, workers=1):
         self.scorer = scorer
+        self.best_first = best_first
+        self.budget = budget
+        self.workers = workers
 
     def learn(self, train_reader: DataReader, dev_reader: DataReader):
+        self.close_pool()
         for i in range(5):
             self.scorer.learn(train_reader, dev_reader)
             if not self.scorer.is_trainable:
@@ -24,15 +35,75 @@ class NaivePlanner(Planner):
     def score(self, g: Graph, plan: str):
         return self.scorer.score(plan)
 
+    def scores(self, batch):
+        # Log-scores, ranked the same as score, computed for the whole batch together
+        return self.scorer.log_scores([plan for g, plan in batch])
+
     def plan_best(self, g: Graph, ranker_plans=None):
+        if self.budget is not None:
+            self.budget.start()
+
+        if not ranker_plans and self.best_first:
+            return self.budgeted(self.plan_top_k(g, 50))
+
+        if not ranker_plans and self.workers > 1 and self.budget is None:
+            return self.plan_top_parallel(g, 50)
+
         if ranker_plans:
             all_plans = list(set(ranker_plans))
         else:
-            all_plans = list(self.plan_all(g))
+            all_plans = self.plan_iter(g)
+
+        best_50_plans = [p for p, s in top_plans(self, g, tqdm(all_plans), 50, self.batch_size)]
+
+        return self.budgeted(best_50_plans)
+
+    def plan_top_k(self, g: Graph, k: int):
+        # A* over partial plans. The scorer bounds the log-score of any completion of a partial plan,
+        # so the first k complete plans out of the queue are the exact top k.
+        scorer = self.scorer
+        bounds_cache = {}
+
+        structure = self.plan_structure(g)
+        tie = count()
+        queue = [(0, next(tie), scorer.start(), push_frames(None, [structure]), None, False)]
+        best = []
+        seen = set()
+
+        while len(queue) > 0 and len(best) < k:
+            reason = self.budget.exhausted() if self.budget is not None else None
+            if reason:
+                # The plans found so far are still the exact best, the rest are sampled
+                self.budget.degrade(reason, "sampled after " + str(len(best)) + " best plans")
+                sampled = [p for p in structure.sample(min(k, structure.count())) if p not in seen]
+                best += sorted(sampled, key=scorer.score, reverse=True)[:k - len(best)]
+                break
+
+            _, _, state, stack, pieces, is_complete = heappop(queue)
+
+            if is_complete:
+                plan = []
+                while pieces is not None:
+                    piece, pieces = pieces
+                    plan.append(piece)
+                plan = "".join(reversed(plan))
+                if plan not in seen:
+                    seen.add(plan)
+                    best.append(plan)
+                continue
+
+            new_pieces, options = plan_choices(stack)
+            for piece in new_pieces:
+                state = scorer.feed(state, piece)
+                pieces = (piece, pieces)
 
-        plan_scores = [(p, self.scorer.score(p)) for p in tqdm(all_plans)]
-        plan_scores = sorted(plan_scores, key=lambda a: a[1], reverse=True)
+            for option in options:
+                if option is None:
+                    heappush(queue, (-scorer.complete(state), next(tie), state, None, pieces, True))
+                    continue
 
-        best_50_plans = [p for p, s in plan_scores[:50]]
+                bounds = stack_bounds(option, scorer.piece_bound, bounds_cache)
+                if bounds is not None:
+                    heappush(queue, (-scorer.bound(state, *bounds), next(tie), state, option, pieces, False))
 
-        return best_50_plans
+        return best
@@ -18,6 +18,8 @@ from scorer.scorer import get_relations
 from utils.delex import concat_entity
 from utils.dynet_model_executer import Vocab, DynetModelExecutor, BaseDynetModel, arg_sample
 from utils.graph import Graph, readable_edge
+from utils.plan import Plan
+from utils.plan_codec import decode
 from utils.tokens import tokenize
 
 
@@ -218,10 +220,11 @@ class NeuralPlanner(Planner):
         return "_".join(tokenize(readable_edge(r)))
 
     def convert_graph(self, g: Graph):
-        rdf = [(concat_entity(s), self.convert_relation(r), concat_entity(o)) for s, r, o in g.as_rdf()]
-        return Graph(rdf)
+        # Converts every distinct node and relation once, instead of once per edge
+        return g.compact().relabel(concat_entity, self.convert_relation).to_graph()
 
     def convert_plan(self, p: str):
+        p = decode(p)
         relations = get_relations(p)
         for d, r in relations:
             p = p.replace(r, self.convert_relation(r))
@@ -231,7 +234,8 @@ class NeuralPlanner(Planner):
 
         p = p.replace("].", "] .")
 
-        return re.sub("\[(\w)", r"[ \1", p)
+        # Parsed, so fix_out does not parse it again
+        return Plan(re.sub("\[(\w)", r"[ \1", p))
 
     def convert_set(self, reader: DataReader):
         return [(self.convert_graph(d.graph), self.convert_plan(d.plan)) for d in reader.copy().data]
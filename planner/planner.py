@@ -1,13 +1,78 @@
-from random import sample
+from heapq import nlargest
+from itertools import chain, islice
+from multiprocessing.pool import Pool
 from typing import Tuple, List
 
 from data.reader import DataReader
-from utils.graph import Graph
+from utils.budget import BudgetExhausted
+from utils.graph import Graph, shards
+
+worker_planner = None  # Planner of a plan_top_parallel worker
+
+
+def init_worker(planner):
+    global worker_planner
+    worker_planner = planner
+
+
+def top_scored(plan_scores, k):
+    # Stable, so plans with equal scores keep their order, as in a single process
+    if k is None:
+        return sorted(plan_scores, key=lambda a: a[1], reverse=True)
+    return nlargest(k, plan_scores, key=lambda a: a[1])
+
+
+def top_plans(planner, g: Graph, plans, k, batch_size):
+    plans = iter(plans)
+    best = []
+    while True:
+        batch = list(islice(plans, batch_size))
+        if len(batch) == 0:
+            break
+        best = top_scored(best + list(zip(batch, planner.scores([(g, p) for p in batch]))), k)
+    return best
+
+
+def shard_top_plans(args):
+    g, structure, k, batch_size = args
+    return top_plans(worker_planner, g, structure.iter_linearizations(), k, batch_size)
+
+
+class BestPlans(list):
+    # Plans from plan_best, with the strategies planning degraded to when out of budget
+    def __init__(self, plans, degraded=None):
+        super().__init__(plans)
+        self.degraded = list(degraded) if degraded else []
 
 
 class Planner:
     is_parallel = False
     re_plan = False
+    plan_cache = None
+    entity_agnostic = False  # Scores only depend on the graph's shape and relations, not on its entities
+    budget = None  # PlanBudget, started by plan_best for every graph
+    workers = 1  # Processes a single graph's plan space is enumerated and scored in, for is_parallel planners
+    parallel_min_plans = 100000  # Smaller plan spaces are not worth starting workers for
+    pool = None  # Workers of plan_top_parallel, started once for all the graphs the planner plans
+    log_scored = False  # scores gives the log of score
+
+    def __getstate__(self):
+        # Pools can not be pickled, and plan caches are only shared within a process
+        state = self.__dict__.copy()
+        state.pop("pool", None)
+        state.pop("plan_cache", None)
+        return state
+
+    def worker_pool(self):
+        # Workers get a copy of the planner when started, so the pool is closed when the planner learns again
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=init_worker, initargs=(self,))
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
     def learn(self, train_reader: DataReader, dev_reader: DataReader):
         raise NotImplementedError("Planner.learn is not implemented")
@@ -21,10 +86,46 @@ class Planner:
     def plan_best(self, g: Graph, ranker_plans=None):
         raise NotImplementedError("Planner.plan_best is not implemented")
 
+    def budgeted(self, plans):
+        if self.budget is None:
+            return plans
+        return BestPlans(plans, self.budget.degraded)
+
+    def plan_structure(self, g: Graph):
+        if self.budget is None:
+            return g.exhaustive_plan(force_tree=False, cache=self.plan_cache)
+
+        try:
+            return g.exhaustive_plan(force_tree=False, cache=self.plan_cache, budget=self.budget)
+        except BudgetExhausted as e:
+            # Without splitting to sentences, the structure is about linear in the graph size
+            self.budget.degrade(str(e), "single sentence plans")
+            return g.plan_all()
+
     def plan_all(self, g: Graph):
-        return g.exhaustive_plan(force_tree=False).linearizations()
+        if self.budget is None:
+            return self.plan_structure(g).linearizations()
+        return list(self.plan_iter(g))
+
+    def plan_iter(self, g: Graph):
+        if self.budget is None:
+            return self.plan_structure(g).iter_linearizations()
+        return self.budget.limit(self.plan_structure(g))
+
+    def plan_top_parallel(self, g: Graph, k=None, batch_size=10000):
+        # The k best plans, or all plans ranked if k is None, same as ranking plan_iter in a single process.
+        # The plan space is split to shards by its choices, enumerated and scored by a pool of workers.
+        structure = self.plan_structure(g)
+        if self.workers <= 1 or structure.count() < self.parallel_min_plans:
+            return [p for p, s in top_plans(self, g, structure.iter_linearizations(), k, batch_size)]
+
+        parts = shards(structure, self.workers * 4)
+        tops = self.worker_pool().map(shard_top_plans, [(g, part, k, batch_size) for part in parts], chunksize=1)
+        return [p for p, s in top_scored(chain.from_iterable(tops), k)]
+
+    def plan_count(self, g: Graph):
+        return self.plan_structure(g).count()
 
     def plan_random(self, g: Graph, amount: int):
-        all_plans = self.plan_all(g)
-        return sample(all_plans, amount)
+        return self.plan_structure(g).sample(amount)
 
@@ -0,0 +1,20 @@
+from planner.combined import CombinedPlanner
+from planner.planner import Planner
+from utils.budget import PlanBudget
+from utils.graph import Graph
+
+
+class FirstPlanner(Planner):
+    def plan_best(self, g: Graph, ranker_plans=None):
+        return self.plan_structure(g).linearization(0)
+
+
+def test_greedy_plan_out_of_time():
+    g = Graph([("A", "r", "B"), ("B", "s", "C"), ("A", "t", "D")])
+    ranker = FirstPlanner()
+    planner = CombinedPlanner((ranker, FirstPlanner()), budget=PlanBudget(seconds=0))
+
+    plans = planner.plan_best(g)
+    assert plans == [g.plan_all().linearization(0)]
+    assert plans.degraded == ["time: single sentence plans", "time: greedy plan"]
+    assert ranker.budget is None and ranker.plan_cache is None
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from planning_benchmark import make_graph, synthetic_planner
+from utils.budget import PlanBudget
+
+
+@pytest.fixture(scope="module")
+def planner():
+    return synthetic_planner()
+
+
+def log_scores(planner, plans):
+    return list(planner.scorer.log_scores(plans))
+
+
+def graphs():
+    rng = random.Random(0)
+    for shape, size in [("star", 3), ("tree", 4), ("cyclic", 4), ("multi-edge", 4), ("chain", 5)]:
+        yield make_graph(shape, size, rng)
+
+
+def test_plan_top_k_is_exact(planner):
+    for g in graphs():
+        best = planner.plan_top_k(g, 10)
+        plans = planner.plan_structure(g).linearizations()
+        assert len(set(best)) == len(best) == 10
+        assert set(best) <= set(plans)
+        assert log_scores(planner, best) == sorted(log_scores(planner, plans), reverse=True)[:10]
+
+
+def test_top_plans_in_batches(planner):
+    g = make_graph("tree", 4, random.Random(0))
+    serial = planner.plan_best(g)
+    planner.batch_size, batch_size = 7, planner.batch_size
+    try:
+        assert planner.plan_best(g) == serial
+    finally:
+        planner.batch_size = batch_size
+    assert log_scores(planner, serial) == log_scores(planner, planner.plan_top_k(g, 50))
+
+
+@pytest.fixture
+def out_of_time(planner):
+    planner.best_first, planner.budget = True, PlanBudget(seconds=0)
+    yield planner
+    planner.best_first, planner.budget = False, None
+
+
+def test_plan_structure_out_of_time(out_of_time):
+    g = make_graph("star", 4, random.Random(0))
+    out_of_time.budget.start()
+    assert out_of_time.plan_structure(g).linearizations() == g.plan_all().linearizations()
+    assert out_of_time.budget.degraded == ["time: single sentence plans"]
+
+
+def test_plan_top_k_out_of_time_samples(out_of_time):
+    # Fewer plans than asked for, and more
+    for g in [make_graph("chain", 2, random.Random(0)), make_graph("star", 5, random.Random(0))]:
+        plans = out_of_time.plan_best(g)
+        assert len(set(plans)) == len(plans) == min(50, g.plan_all().count())
+        assert set(plans) <= set(g.plan_all().linearizations())
+        assert plans.degraded == ["time: single sentence plans", "time: sampled after 0 best plans"]
@@ -0,0 +1,202 @@
+import argparse
+import json
+import pickle
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from data.reader import DataReader, Datum
+from planner.naive_planner import NaivePlanner
+from scorer.global_direction import GlobalDirectionExpert
+from scorer.product_of_experts import WeightedProductOfExperts
+from scorer.relation_direction import RelationDirectionExpert
+from scorer.relation_transitions import RelationTransitionsExpert
+from scorer.splitting_tendencies import SplittingTendenciesExpert
+from utils.graph import Graph
+
+SHAPES = ["star", "chain", "tree", "cyclic", "multi-edge"]
+
+
+def relation(i: int):
+    return "relation" + str(i % 4)  # Few relations, so the experts see each one many times
+
+
+def make_graph(shape: str, size: int, rng: random.Random):
+    # A graph of the shape with `size` edges, or None if there is no such graph
+    if shape == "star":
+        edges = [("center", "leaf" + str(i)) for i in range(size)]
+    elif shape == "chain":
+        edges = [("node" + str(i), "node" + str(i + 1)) for i in range(size)]
+    elif shape == "tree":
+        edges = [("node" + str(rng.randrange(i + 1)), "node" + str(i + 1)) for i in range(size)]
+    elif shape == "cyclic":
+        if size < 3:
+            return None
+        edges = [("node" + str(i), "node" + str((i + 1) % size)) for i in range(size)]
+    elif shape == "multi-edge":
+        if size < 2:
+            return None
+        # A chain where every pair of nodes is connected twice, with an extra edge for odd sizes
+        edges = [("node" + str(i // 2), "node" + str(i // 2 + 1)) for i in range(size)]
+    else:
+        raise ValueError("Unknown graph shape " + shape)
+
+    return Graph([(s, relation(i), o) for i, (s, o) in enumerate(edges)])
+
+
+def sentence_constraints(g: Graph, sentence_size=3):
+    # Constraints like match_plan makes, for sentences of up to `sentence_size` edges in the graph's edge order
+    rdfs = g.as_rdf()
+    components = []
+    for i in range(0, len(rdfs), sentence_size):
+        must_include = {n for s, r, o in rdfs[i:i + sentence_size] for n in (s, o)}
+        must_exclude = g.nodes - must_include
+        for n1, n2 in g.undirected_edges.keys():
+            if n1 in must_include and n2 in must_exclude:
+                must_exclude.remove(n2)
+        components.append({"must_include": must_include, "must_exclude": must_exclude})
+    return components
+
+
+def synthetic_planner():
+    # A NaivePlanner whose experts learn from a random plan of every benchmark graph, with a fixed seed
+    rng = random.Random(0)
+    random.seed(0)
+    data = []
+    for shape in SHAPES:
+        for size in range(1, 8):
+            g = make_graph(shape, size, rng)
+            if g is not None:
+                structure = g.exhaustive_plan()
+                data += [Datum(plan=p) for p in structure.sample(min(5, structure.count()))]
+
+    planner = NaivePlanner(WeightedProductOfExperts([
+        RelationDirectionExpert,
+        GlobalDirectionExpert,
+        SplittingTendenciesExpert,
+        RelationTransitionsExpert
+    ]))
+    reader = DataReader(data)
+    return planner.learn(reader, reader)
+
+
+def measure(f, repeats: int):
+    # Best wall-clock seconds of the repeats, and peak traced memory in KB of one more run
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {"seconds": min(seconds), "peak_kb": peak / 1024}
+
+
+def run(max_size: int, repeats: int, max_plans: int, planners):
+    rng = random.Random(0)
+    results = {}
+    for shape in SHAPES:
+        for size in range(1, max_size + 1):
+            g = make_graph(shape, size, rng)
+            if g is None:
+                continue
+
+            # The graph is compacted once, so every measurement starts from the same state
+            g.compact()
+            constraints = sentence_constraints(g)
+            cases = {
+                "plan_all": lambda: g.plan_all(),
+                "exhaustive_plan": lambda: g.exhaustive_plan(),
+                "traverse_all": lambda: g.traverse_all(),
+                "constraint_graphs_plan": lambda: g.constraint_graphs_plan(constraints),
+            }
+
+            graph_results = {}
+            for name, f in cases.items():
+                structure, stats = measure(f, repeats)
+                stats["plans"] = structure.count()
+                graph_results[name] = stats
+
+            # Planners score every plan, so graphs with too many are left out
+            plans = graph_results["exhaustive_plan"]["plans"]
+            for name, planner in planners.items():
+                if planner is None or plans > max_plans:
+                    graph_results[name + ".plan_best"] = None
+                    continue
+                best, stats = measure(lambda: planner.plan_best(g), repeats)
+                stats["plans"] = len(best) if isinstance(best, list) else 1
+                graph_results[name + ".plan_best"] = stats
+
+            results[shape + "/" + str(size)] = graph_results
+            print(shape, size, {k: v and round(v["seconds"], 4) for k, v in graph_results.items()}, file=sys.stderr)
+
+    return results
+
+
+def compare(results, baseline, tolerance: float, slack: float):
+    # Plan counts must match the baseline. Time and memory may grow by the tolerance factor, plus some slack
+    regressions = []
+    for graph, cases in baseline.items():
+        for case, base in cases.items():
+            current = results.get(graph, {}).get(case)
+            if base is None or current is None:
+                continue
+
+            name = graph + " " + case
+            if current["plans"] != base["plans"]:
+                regressions.append(name + ": " + str(base["plans"]) + " plans -> " + str(current["plans"]))
+            if current["seconds"] > base["seconds"] * tolerance + slack:
+                regressions.append(name + ": " + "%.4fs -> %.4fs" % (base["seconds"], current["seconds"]))
+            if current["peak_kb"] > base["peak_kb"] * tolerance + slack * 1024:
+                regressions.append(name + ": " + "%.0fKB -> %.0fKB" % (base["peak_kb"], current["peak_kb"]))
+    return regressions
+
+
+def load_planner(path: str):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Planning benchmark over graph shapes and sizes")
+    parser.add_argument("--max-size", type=int, default=10, help="Largest graph, in edges")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-plans", type=int, default=100000, help="Largest plan space planners are timed on")
+    parser.add_argument("--neural-planner", type=str, default=None, help="Pickled, trained NeuralPlanner")
+    parser.add_argument("--naive-planner", type=str, default=None,
+                        help="Pickled, trained NaivePlanner. A synthetic one is trained if not given")
+    parser.add_argument("--out", type=str, default=None, help="Where to write the results JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Allowed time and memory growth factor")
+    parser.add_argument("--slack", type=float, default=0.01, help="Allowed time growth in seconds (and in MB)")
+    args = parser.parse_args()
+
+    planners = {
+        "NaivePlanner": load_planner(args.naive_planner) if args.naive_planner else synthetic_planner(),
+        "NeuralPlanner": load_planner(args.neural_planner) if args.neural_planner else None
+    }
+
+    output = {
+        "meta": {"python": platform.python_version(), "machine": platform.machine(),
+                 "max_size": args.max_size, "repeats": args.repeats, "max_plans": args.max_plans},
+        "results": run(args.max_size, args.repeats, args.max_plans, planners)
+    }
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(output["results"], json.load(f)["results"], args.tolerance, args.slack)
+        for r in regressions:
+            print("REGRESSION", r, file=sys.stderr)
+        sys.exit(1 if len(regressions) > 0 else 0)
@@ -15,8 +15,8 @@ TestCorpusPreProcessPipeline = CorpusPreProcessPipeline.mutate({})  # Test does
 
 CorpusPreProcessPipeline.enqueue("match-ents", "Match Entities", lambda f, _: f["entities"].copy().match_entities())
 CorpusPreProcessPipeline.enqueue("match-plans", "Match Plans", lambda f, _: f["match-ents"].copy().match_plans())
-CorpusPreProcessPipeline.enqueue("tokenize", "Tokenize Plans & Sentences",
-                                 lambda f, _: f["match-plans"].copy().tokenize_plans().tokenize_delex())
+CorpusPreProcessPipeline.enqueue("tokenize", "Tokenize & Encode Plans, Tokenize Sentences",
+                                 lambda f, _: f["match-plans"].copy().tokenize_plans().tokenize_delex().encode_plans())
 CorpusPreProcessPipeline.enqueue("to-json", "Export in a readable format",
                                  lambda f, _: json.dumps(f["tokenize"].export()), ext="json")
 CorpusPreProcessPipeline.enqueue("out", "Make output for parent", lambda f, _: f["tokenize"].copy())
@@ -29,7 +29,9 @@ TestCorpusPreProcessPipeline.enqueue("plan", "Generate best plan",
                                      lambda f, x: f["entities"].copy().create_plans(x["train-planner"]))
 TestCorpusPreProcessPipeline.enqueue("timing", "Chart the timing",
                                      lambda f, x: error_bar(f["plan"].timing, "Time (seconds)", "#Edges"), ext="pdf")
-TestCorpusPreProcessPipeline.enqueue("tokenize", "Tokenize Plans", lambda f, _: f["plan"].copy().tokenize_plans())
+TestCorpusPreProcessPipeline.enqueue("plan-space", "Chart the plan-space size",
+                                     lambda f, x: error_bar(f["plan"].plan_space, "#Plans", "#Edges"), ext="pdf")
+TestCorpusPreProcessPipeline.enqueue("tokenize", "Tokenize & Encode Plans", lambda f, _: f["plan"].copy().tokenize_plans().encode_plans())
 TestCorpusPreProcessPipeline.enqueue("out", "Make output for parent", lambda f, _: f["tokenize"].copy())
 
 TestingPreProcessPipeline = Pipeline()
@@ -1,12 +1,13 @@
 from collections import defaultdict
 from utils.pipeline import Pipeline
+from utils.plan_codec import decode
 
 
 def unique_plans_outputs(reader):
     plan_hyp_refs = defaultdict(lambda: ["", []])
     for d in reader.data:
-        plan_hyp_refs[d.plan][0] = d.hyp
-        plan_hyp_refs[d.plan][1].append(d.text)
+        plan_hyp_refs[decode(d.plan)][0] = d.hyp
+        plan_hyp_refs[decode(d.plan)][1].append(d.text)
 
     return dict(plan_hyp_refs)
 
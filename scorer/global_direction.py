@@ -1,7 +1,9 @@
 from collections import defaultdict, Counter
 from typing import List
 
-from scorer.product_of_experts import Expert
+import numpy as np
+
+from scorer.product_of_experts import Expert, PlanBatch, safe_log
 from scorer.scorer import get_relations
 
 
@@ -25,7 +27,13 @@ class GlobalDirectionExpert(Expert):
         matches = get_relations(plan)
         forward = len(list(filter(lambda a: a[0] == ">", matches)))
 
-        relations = len(matches)
+        return self.prob(len(matches), forward)
+
+    def log_batch(self, batch: PlanBatch):
+        keys = np.stack([batch.relations, batch.forward], axis=1)
+        return batch.unique_values(keys, lambda relations, forward: safe_log(self.prob(relations, forward)))
+
+    def prob(self, relations: int, forward: int):
         direction = forward / (relations + 1)
 
         if relations not in self.probs:
@@ -35,3 +43,18 @@ class GlobalDirectionExpert(Expert):
             return self.probs[relations]["UNK"]  # Never encountered such percentage
 
         return self.probs[relations][direction]
+
+    # The state is the number of forward relations so far
+
+    def start(self):
+        return 0
+
+    def relation(self, state, d: str, r: str):
+        return state + (d == ">"), 0
+
+    def end(self, state, relations: int):
+        return safe_log(self.prob(relations, state))
+
+    def bound(self, state, relations: int, min_left: int, max_left: int):
+        return max(self.end(state + forward, relations + left)
+                   for left in range(min_left, max_left + 1) for forward in range(left + 1))
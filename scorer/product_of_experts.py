@@ -1,14 +1,119 @@
+from array import array
+from collections import defaultdict
 from functools import reduce
+from itertools import count
+from math import log, inf
 from operator import mul
 
+import numpy as np
+
 from data.reader import DataReader
-from scorer.scorer import Scorer
+from scorer.scorer import Scorer, get_relations, get_sentences
+from utils.plan import parse_plan
+
+
+def safe_log(p):
+    return log(p) if p > 0 else -inf
+
+
+class PlanBatch:
+    # Plans as integer matrices, for scoring them together. The plans of a graph share most of their sentences,
+    # so relations are parsed and featurized once per distinct sentence, and plans are rows of sentence ids.
+    # The last sentence id is padding, with no relations.
+    def __init__(self, plans):
+        self.plans = plans
+
+        # Sentences are turned to ids plan by plan, so only distinct sentences are kept as strings
+        ids = defaultdict(count().__next__)
+        lengths = array("q")
+        flat = array("q")
+        for p in plans:
+            sentences = p.split(".") if isinstance(p, str) else get_sentences(p)
+            lengths.append(len(sentences))
+            flat.extend(map(ids.__getitem__, sentences))
+        lengths = np.frombuffer(lengths, dtype=np.int64)
+        flat = np.frombuffer(flat, dtype=np.int64)
+        width = int(lengths.max()) if len(plans) > 0 else 0
+        self.sentences = np.full((len(plans), width), len(ids), dtype=np.int64)
+        self.sentences[np.arange(width) < lengths[:, None]] = flat
+
+        self.sentence_relations = [get_relations(s) for s in ids] + [()]
+        self.sizes = np.array([len(r) for r in self.sentence_relations], dtype=np.int64)
+        forward = np.array([sum(d == ">" for d, r in rels) for rels in self.sentence_relations], dtype=np.int64)
+
+        self.relations = self.sizes[self.sentences].sum(axis=1)
+        self.forward = forward[self.sentences].sum(axis=1)
+
+    def __len__(self):
+        return len(self.plans)
+
+    def sentence_sums(self, f):
+        # Sum over every plan's sentences of f(relations of the sentence)
+        values = np.array([f(rels) for rels in self.sentence_relations[:-1]] + [0.0])
+        return values[self.sentences].sum(axis=1)
+
+    def unique_values(self, keys: np.ndarray, f):
+        # f(*key) of every plan's row of keys, called once per distinct row
+        if len(self) == 0:
+            return np.zeros(0)
+
+        low = keys.min()
+        base = int(keys.max() - low) + 1
+        if base ** keys.shape[1] < 2 ** 62:
+            # Rows as single integers, which are much faster to find unique
+            codes = ((keys - low) * base ** np.arange(keys.shape[1], dtype=np.int64)).sum(axis=1)
+            unique, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+            unique = keys[first]
+        else:
+            unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+        values = np.array([f(*row) for row in unique.tolist()])
+        return values[inverse.reshape(-1)]
+
+    def splits(self):
+        # Relations per sentence of every plan, padded with -1
+        sizes = self.sizes.copy()
+        sizes[-1] = -1
+        return sizes[self.sentences]
 
 
 class Expert:
+    per_relation = False  # Does eval return a score per relation, to be averaged
+
     def eval(self, plan: str):
         raise NotImplementedError("Must implement eval")
 
+    # Incremental evaluation, feeding the plan one relation or sentence break at a time, in log-space.
+    # Relation scores are attributed to one relation each, so they can be bounded per relation.
+
+    def start(self):
+        raise NotImplementedError("Must implement start for incremental evaluation")
+
+    def relation(self, state, d: str, r: str):
+        return state, 0
+
+    def sentence(self, state):
+        return state, 0
+
+    def end(self, state, relations: int):
+        return 0
+
+    def relation_bound(self, d: str, r: str):
+        return 0
+
+    def bound(self, state, relations: int, min_left: int, max_left: int):
+        # Upper bound on everything not yet returned for a prefix with this state
+        return 0
+
+    # Batch evaluation, in log-space. Per relation experts return the sum of their relations' log scores.
+
+    def log_batch(self, batch: PlanBatch):
+        logs = []
+        for plan in batch.plans:
+            s = self.eval(plan)
+            logs.append(sum(map(safe_log, s)) if self.per_relation else safe_log(s))
+        return np.array(logs)
+
 
 class WeightedProductOfExperts(Scorer):
     def __init__(self, expert_constructors):
@@ -18,11 +123,60 @@ class WeightedProductOfExperts(Scorer):
 
     def learn(self, train_reader: DataReader, dev_reader: DataReader):
         if len(self.experts) == 0:
-            plans = [d.plan for d in train_reader.data]
+            plans = [parse_plan(d.plan) for d in train_reader.data]
             self.experts = [e(plans) for e in self.expert_constructors]
             self.weights = [1 for _ in self.experts]
 
     def score(self, plan: str):
+        plan = parse_plan(plan)  # Once, for all the experts
         scores = [e.eval(plan) for e in self.experts]
         scores = [pow(reduce(mul, s, 1), 1 / len(s)) if isinstance(s, list) else s for s in scores]
         return reduce(mul, scores, 1)
+
+    def log_scores(self, plans):
+        # log(score) of every plan, computed together
+        batch = PlanBatch(plans)
+        relations = np.maximum(batch.relations, 1)
+        scores = np.zeros(len(batch))
+        for e in self.experts:
+            logs = e.log_batch(batch)
+            scores += logs / relations if e.per_relation else logs
+        # Plans often tie, up to rounding errors, which would break the ties instead of the plans' order
+        return np.round(scores, 12)
+
+    # Incremental log-score. State is (expert states, sum of per relation log scores, #relations)
+
+    def start(self):
+        return tuple(e.start() for e in self.experts), 0, 0
+
+    def feed(self, state, piece: str):
+        states, relation_sum, relations = state
+
+        if piece == ". ":
+            states, logs = zip(*[e.sentence(s) for e, s in zip(self.experts, states)])
+            return states, relation_sum + sum(l for e, l in zip(self.experts, logs) if e.per_relation), relations
+
+        for d, r in get_relations(piece):
+            states, logs = zip(*[e.relation(s, d, r) for e, s in zip(self.experts, states)])
+            relation_sum += sum(l for e, l in zip(self.experts, logs) if e.per_relation)
+            relations += 1
+
+        return states, relation_sum, relations
+
+    def piece_bound(self, piece: str):
+        relations = get_relations(piece)
+        return len(relations), sum(e.relation_bound(d, r) for d, r in relations for e in self.experts)
+
+    def complete(self, state):
+        states, relation_sum, relations = state
+        ends = [e.end(s, relations) for e, s in zip(self.experts, states)]
+        relation_sum += sum(l for e, l in zip(self.experts, ends) if e.per_relation)
+        return relation_sum / relations + sum(l for e, l in zip(self.experts, ends) if not e.per_relation)
+
+    def bound(self, state, min_left: int, max_left: int, relation_bound: float):
+        states, relation_sum, relations = state
+        bounds = [e.bound(s, relations, min_left, max_left) for e, s in zip(self.experts, states)]
+        relation_sum += relation_bound + sum(b for e, b in zip(self.experts, bounds) if e.per_relation)
+        # Relation sums are never positive, so the most relations gives the highest average
+        return relation_sum / max(relations + max_left, 1) + \
+               sum(b for e, b in zip(self.experts, bounds) if not e.per_relation)
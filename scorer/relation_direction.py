@@ -2,13 +2,15 @@ from typing import List
 
 import numpy as np
 
-from scorer.product_of_experts import Expert
+from scorer.product_of_experts import Expert, PlanBatch, safe_log
 from scorer.scorer import get_relations
 
 
 class RelationDirectionExpert(Expert):
+    per_relation = True
+
     def __init__(self, plans: List[str]):
-        matches = get_relations("\n".join(plans))
+        matches = [m for plan in plans for m in get_relations(plan)]
 
         direction = {}
 
@@ -29,3 +31,19 @@ class RelationDirectionExpert(Expert):
             relation = "UNK" if match[1] not in self.probs else match[1]
             scores.append(self.probs[relation] if match[0] == ">" else (1 - self.probs[relation]))
         return scores
+
+    def log_batch(self, batch: PlanBatch):
+        return batch.sentence_sums(lambda relations: sum(safe_log(self.prob(d, r)) for d, r in relations))
+
+    def prob(self, d: str, r: str):
+        relation = "UNK" if r not in self.probs else r
+        return self.probs[relation] if d == ">" else (1 - self.probs[relation])
+
+    def start(self):
+        return None
+
+    def relation(self, state, d: str, r: str):
+        return state, safe_log(self.prob(d, r))
+
+    def relation_bound(self, d: str, r: str):
+        return safe_log(self.prob(d, r))
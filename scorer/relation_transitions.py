@@ -1,16 +1,18 @@
 from collections import defaultdict, Counter
 from typing import List
 
-from scorer.product_of_experts import Expert
-from scorer.scorer import get_relations
+from scorer.product_of_experts import Expert, PlanBatch, safe_log
+from scorer.scorer import get_relations, get_sentences
 
 
 class RelationTransitionsExpert(Expert):
+    per_relation = True
+
     def __init__(self, plans: List[str]):
         adjacent = defaultdict(Counter)
 
         for plan in plans:
-            for p in plan.split("."):
+            for p in get_sentences(plan):
                 matches = get_relations(p)
 
                 for i in range(len(matches) - 1):
@@ -24,23 +26,54 @@ class RelationTransitionsExpert(Expert):
             self.probs[e] = {p: n / total for p, n in c.items()}
             self.probs[e]["UNK"] = 1 / total
 
-    def eval(self, plan: str):
-        def get_prob(r1, r2):
-            if r1 not in self.probs:
-                return 1  # Never encountered such edge
+    def sentence_log(self, relations):
+        if len(relations) == 0:
+            return 0
+        logs = [safe_log(self.get_prob(r1, r2)) for (d1, r1), (d2, r2) in zip(relations, relations[1:])]
+        return sum(logs) + safe_log(self.get_prob(relations[-1][1], "EOS"))
+
+    def log_batch(self, batch: PlanBatch):
+        return batch.sentence_sums(self.sentence_log)
 
-            if r2 not in self.probs[r1]:
-                return self.probs[r1]["UNK"]  # Never encountered such adjacency
+    def get_prob(self, r1, r2):
+        if r1 not in self.probs:
+            return 1  # Never encountered such edge
 
-            return self.probs[r1][r2]
+        if r2 not in self.probs[r1]:
+            return self.probs[r1]["UNK"]  # Never encountered such adjacency
 
+        return self.probs[r1][r2]
+
+    def eval(self, plan: str):
         scores = []
 
-        for p in plan.split("."):
+        for p in get_sentences(plan):
             matches = get_relations(p)
 
             for i in range(len(matches) - 1):
-                scores.append(get_prob(matches[i][1], matches[i + 1][1]))
-            scores.append(get_prob(matches[-1][1], "EOS"))
+                scores.append(self.get_prob(matches[i][1], matches[i + 1][1]))
+            scores.append(self.get_prob(matches[-1][1], "EOS"))
 
         return scores
+
+    # The state is the last relation of the current sentence. Its score is known only when the next one comes.
+
+    def start(self):
+        return None
+
+    def relation(self, state, d: str, r: str):
+        return r, 0 if state is None else safe_log(self.get_prob(state, r))
+
+    def sentence(self, state):
+        return None, 0 if state is None else safe_log(self.get_prob(state, "EOS"))
+
+    def end(self, state, relations: int):
+        return self.sentence(state)[1]
+
+    def relation_bound(self, d: str, r: str):
+        if r not in self.probs:
+            return 0
+        return safe_log(max(self.probs[r].values()))
+
+    def bound(self, state, relations: int, min_left: int, max_left: int):
+        return 0 if state is None else self.relation_bound(None, state)
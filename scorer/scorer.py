@@ -1,37 +1,111 @@
 import re
 from functools import lru_cache, reduce
+from itertools import islice
+from math import log, inf, exp, sqrt
+from multiprocessing.pool import Pool
 from operator import mul
-from random import shuffle
+from random import sample, random
+
+import numpy as np
+from tqdm import tqdm
 
 from data.reader import DataReader
-from utils.star import star
+from utils.plan import Plan
+from utils.plan_codec import EncodedPlan, decode
+
+
+def get_relations(plan):
+    if isinstance(plan, Plan):
+        return plan.relations
+    if isinstance(plan, EncodedPlan):
+        return plan.relations()
+    return get_string_relations(plan)
 
 
 @lru_cache(maxsize=None)
-def get_relations(plan: str):
+def get_string_relations(plan: str):
     return list(re.findall("(<|>) (.*?) \[", plan))
 
 
+def get_sentences(plan):
+    if isinstance(plan, Plan):
+        return plan.sentences
+    if isinstance(plan, EncodedPlan):
+        return plan.sentences()
+    return plan.split(".")
+
+
+def rank_plan(scorer, plan, plans, max_plans=99999, batch_size=10000):
+    # Index of the reference plan among its datum's plans sorted by score, and the number of plans sorted. Up to
+    # max_plans random candidates are followed by the reference, and the sort is stable, so tied candidates come
+    # before the reference, up to its first copy among them. Candidates are streamed in batches and only counted.
+    if max_plans is not None and len(plans) > max_plans:
+        plans = map(plans.__getitem__, sorted(sample(range(len(plans)), max_plans)))
+
+    reference = scorer.log_scores([plan])[0]
+    plan = decode(plan)
+    plans = iter(plans)
+    higher = tied = copies = total = 0
+    while True:
+        batch = list(islice(plans, batch_size))
+        if len(batch) == 0:
+            break
+        scores = np.asarray(scorer.log_scores(batch))
+        higher += int(np.count_nonzero(scores > reference))
+        ties = np.flatnonzero(scores == reference)
+        tied += len(ties)
+        copies += sum(1 for i in ties if decode(batch[i]) == plan)
+        total += len(batch)
+
+    # Candidates were shuffled, so the first copy is a random one among the ties
+    ahead = tied - copies
+    if copies > 0:
+        ahead = 0
+        while ahead < tied - copies and random() * (tied - ahead) >= copies:
+            ahead += 1
+    return higher + ahead, total + 1
+
+
+worker_scorer = None  # Scorer of an eval worker
+
+
+def init_worker(scorer):
+    global worker_scorer
+    worker_scorer = scorer
+
+
+def rank_datum(task):
+    return rank_plan(worker_scorer, *task)
+
+
 class Scorer:
     is_trainable = False
 
-    def eval(self, reader: DataReader):
-        rank_scores = []
-        for d in reader.data:
-            plan = d.plan
-            plans = d.plans
-            shuffle(plans)
-            plans = plans[:99999]
-            plans.append(plan)
-            plans = list(map(lambda s, p: p, sorted(
-                zip([self.score(p) for p in plans], plans), key=star(lambda s, p: s), reverse=True)))
-
-            rank_scores.append(plans.index(plan) / len(plans))
+    def ranks(self, reader: DataReader, workers=1, max_plans=99999, batch_size=10000):
+        # (index, #plans) of every datum's reference plan, see rank_plan
+        tasks = [(d.plan, d.plans, max_plans, batch_size) for d in reader.data]
+        if workers <= 1:
+            return [rank_plan(self, *task) for task in tqdm(tasks)]
+        with Pool(workers, initializer=init_worker, initargs=(self,)) as pool:
+            return list(tqdm(pool.imap(rank_datum, tasks), total=len(tasks)))
 
+    def eval(self, reader: DataReader, workers=1, max_plans=99999, batch_size=10000):
+        rank_scores = [index / size for index, size in self.ranks(reader, workers, max_plans, batch_size)]
         return pow(reduce(mul, rank_scores, 1), 1 / len(rank_scores))
 
+    def eval_interval(self, reader: DataReader, workers=1, max_plans=99999, batch_size=10000, z=1.96):
+        # Geometric mean of 1-based ranks, (index + 1) / #plans, and its confidence interval (z=1.96 for 95%).
+        # Unlike eval, a reference plan ranked first does not zero the mean, so the log ranks have a standard error.
+        logs = np.log([(index + 1) / size for index, size in self.ranks(reader, workers, max_plans, batch_size)])
+        error = z * logs.std(ddof=1) / sqrt(len(logs)) if len(logs) > 1 else 0
+        mean = logs.mean()
+        return exp(mean), (exp(mean - error), exp(mean + error))
+
     def score(self, plan: str):
         raise NotImplementedError("Scorer.eval is not implemented")
 
+    def log_scores(self, plans):
+        return [log(s) if s > 0 else -inf for s in map(self.score, plans)]
+
     def learn(self, train_reader: DataReader, dev_reader: DataReader):
         raise NotImplementedError("Scorer.learn is not implemented")
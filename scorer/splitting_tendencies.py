@@ -1,8 +1,8 @@
 from collections import defaultdict, Counter
 from typing import List
 
-from scorer.product_of_experts import Expert
-from scorer.scorer import get_relations
+from scorer.product_of_experts import Expert, PlanBatch, safe_log
+from scorer.scorer import get_relations, get_sentences
 
 
 class SplittingTendenciesExpert(Expert):
@@ -19,15 +19,22 @@ class SplittingTendenciesExpert(Expert):
             self.probs[e] = {p: n / total for p, n in c.items()}
             self.probs[e]["UNK"] = 1 / total
 
+        self.bounds = {}  # prefix_bound by its arguments
+
     def split(self, plan):
-        return "-".join([str(len(get_relations(p))) for p in plan.split(".")])
+        return "-".join([str(len(get_relations(p))) for p in get_sentences(plan)])
 
     def eval(self, plan: str):
-        matches = get_relations(plan)
-        split = self.split(plan)
+        return self.prob(len(get_relations(plan)), self.split(plan))
+
+    def log_batch(self, batch: PlanBatch):
+        def split_log(*sizes):
+            sizes = [s for s in sizes if s >= 0]
+            return safe_log(self.prob(sum(sizes), "-".join(map(str, sizes))))
 
-        relations = len(matches)
+        return batch.unique_values(batch.splits(), split_log)
 
+    def prob(self, relations: int, split: str):
         if relations not in self.probs:
             return 1  # Never encountered such size
 
@@ -35,3 +42,43 @@ class SplittingTendenciesExpert(Expert):
             return self.probs[relations]["UNK"]  # Never encountered such split
 
         return self.probs[relations][split]
+
+    # The state is the sizes of the finished sentences, and the size of the current one
+
+    def start(self):
+        return (), 0
+
+    def relation(self, state, d: str, r: str):
+        sizes, current = state
+        return (sizes, current + 1), 0
+
+    def sentence(self, state):
+        sizes, current = state
+        return (sizes + (current,), 0), 0
+
+    def end(self, state, relations: int):
+        sizes, current = state
+        return safe_log(self.prob(relations, "-".join(map(str, sizes + (current,)))))
+
+    def bound(self, state, relations: int, min_left: int, max_left: int):
+        sizes, current = state
+        return max(self.prefix_bound(n, sizes, current) for n in range(relations + min_left, relations + max_left + 1))
+
+    def prefix_bound(self, relations: int, sizes: tuple, current: int):
+        key = relations, sizes, current
+        if key not in self.bounds:
+            self.bounds[key] = self.best_prefix(relations, sizes, current)
+        return self.bounds[key]
+
+    def best_prefix(self, relations: int, sizes: tuple, current: int):
+        # Best probability of a split that starts with these finished sentences
+        if relations not in self.probs:
+            return 0
+
+        probs = [self.probs[relations]["UNK"]]
+        for split, p in self.probs[relations].items():
+            if split != "UNK":
+                split = tuple(map(int, split.split("-")))
+                if split[:len(sizes)] == sizes and len(split) > len(sizes) and split[len(sizes)] >= current:
+                    probs.append(p)
+        return safe_log(max(probs))
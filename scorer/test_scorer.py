@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+from scorer.scorer import Scorer, rank_plan
+
+
+class TableScorer(Scorer):
+    def __init__(self, table):
+        self.table = table
+
+    def score(self, plan: str):
+        return self.table[plan]
+
+
+def test_rank_is_index_in_sorted_plans():
+    scorer = TableScorer({"a": 0.4, "b": 0.3, "c": 0.2, "d": 0.1})
+    assert rank_plan(scorer, "a", ["b", "c", "d"]) == (0, 4)
+    assert rank_plan(scorer, "c", ["a", "b", "d"], batch_size=1) == (2, 4)
+
+
+def test_tied_plans_rank_ahead():
+    scorer = TableScorer({"a": 0.5, "b": 0.5, "c": 0.1})
+    assert rank_plan(scorer, "a", ["b", "b", "c"]) == (2, 4)
+    # Up to the first copy of the reference
+    assert rank_plan(scorer, "a", ["a", "c"]) == (0, 3)
+
+
+def test_max_plans_ranks_a_subset():
+    scorer = TableScorer({str(i): i for i in range(100)})
+    index, size = rank_plan(scorer, "99", [str(i) for i in range(99)], max_plans=10)
+    assert (index, size) == (0, 11)
+
+
+def test_eval_is_geometric_mean():
+    scorer = TableScorer({"a": 0.4, "b": 0.3, "c": 0.2})
+    reader = SimpleNamespace(data=[SimpleNamespace(plan="b", plans=["a", "c"]),
+                                   SimpleNamespace(plan="c", plans=["a", "b"])])
+    assert abs(scorer.eval(reader) - (1 / 3 * 2 / 3) ** 0.5) < 1e-9
+
+
+def test_eval_interval_contains_mean():
+    scorer = TableScorer({"a": 0.4, "b": 0.3, "c": 0.2})
+    reader = SimpleNamespace(data=[SimpleNamespace(plan="a", plans=["b", "c"]),
+                                   SimpleNamespace(plan="c", plans=["a", "b"])])
+    mean, (low, high) = scorer.eval_interval(reader)
+    assert abs(mean - (1 / 3 * 3 / 3) ** 0.5) < 1e-9
+    assert low < mean < high
@@ -15,8 +15,11 @@ from scorer.product_of_experts import WeightedProductOfExperts
 from scorer.relation_direction import RelationDirectionExpert
 from scorer.relation_transitions import RelationTransitionsExpert
 from scorer.splitting_tendencies import SplittingTendenciesExpert
+from utils.budget import PlanBudget, BudgetExhausted
 from utils.delex import concat_entity
 from utils.graph import Graph
+from utils.plan_session import PlanSession
+from utils.plan_store import PlanStore
 from data.WebNLG.reader import WebNLGDataReader
 
 naive_planner = NaivePlanner(WeightedProductOfExperts([
@@ -38,10 +41,14 @@ main_config = Config(reader=server_config["reader"], planner=server_config["plan
 base_path = os.path.dirname(os.path.abspath(__file__))
 
 
-def server(pipeline_res, host, port, debug=True):
+def server(pipeline_res, host, port, debug=True, plan_store: PlanStore = None):
     app = Flask(__name__)
     CORS(app)
 
+    # The UI edits a graph a triple at a time, so sub-plans are kept between requests.
+    # Sub-plans are keyed by triples, so requests for different graphs share the session.
+    session = PlanSession(pipeline_res["train-planner"])
+
     # @app.route('/', methods=['GET'])
     # @app.route('/index.html', methods=['GET'])
     # def root():
@@ -62,14 +69,32 @@ def server(pipeline_res, host, port, debug=True):
         graph = Graph(triplets)
         planner = pipeline_res["train-planner"]
 
-        plans = [l.replace("  ", " ")
-                     for l in (graph.exhaustive_plan() if type == "full" else graph.plan_all()).linearizations()]
-        scores = planner.scores([(graph, p) for p in plans])
+        budget = PlanBudget(seconds=10, plans=100000).start()
+
+        if type == "full" and plan_store is not None and planner.entity_agnostic:
+            template_g, slots = graph.canonical()
+            stored = plan_store.get(template_g, slots) if template_g in plan_store else None
+        else:
+            stored = None
+
+        if stored is not None:
+            # Plans are already ranked in the store, so the best ones are read without enumerating the rest
+            plans = stored[:budget.plans]
+        else:
+            try:
+                structure = session.structure(graph, full=type == "full", budget=budget)
+            except BudgetExhausted as e:
+                budget.degrade(str(e), "single sentence plans")
+                structure = graph.plan_all()
+            plans = budget.limit(structure)
+
+        plans = [l.replace("  ", " ") for l in plans]
+        linearizations = [{"l": l, "s": s} for l, s in zip(plans, session.scores(graph, plans))]
 
         return jsonify({
             "concat": {n: concat_entity(n) for n in graph.nodes},
-            "linearizations": list(sorted([{"l": l, "s": s}
-                                           for l, s in zip(plans, scores)], key=lambda p: p["s"], reverse=True))
+            "linearizations": list(sorted(linearizations, key=lambda p: p["s"], reverse=True)),
+            "degraded": budget.degraded
         })
 
     @app.route('/translate', methods=['POST'])
@@ -97,6 +122,8 @@ if __name__ == "__main__":
     parser.add_argument("--ip", type=str, default="0.0.0.0")
     parser.add_argument("--port", type=int, default="5001")
     parser.add_argument("--debug", "-d", action="store_true")
+    parser.add_argument("--plan-store", type=str, default=None, help="Directory of a PlanStore to read plans from")
     args = parser.parse_args()
 
-    server(res, host=args.ip, port=args.port, debug=args.debug)
+    store = PlanStore(args.plan_store) if args.plan_store else None
+    server(res, host=args.ip, port=args.port, debug=args.debug, plan_store=store)
@@ -41,3 +41,14 @@ def comp_order(ref, plan, skippable=set()):
             skippable.add(ref[i])
 
     return True
+
+
+def order_step(ref, i, token):
+    # comp_order over a stream: the reference position after reading one more plan token, or None if it fails
+    if i == len(ref):
+        return i
+    if token == ref[i]:
+        return i + 1
+    if token != SENTENCE_BREAK and token in ref[:i]:
+        return i
+    return None
@@ -0,0 +1,75 @@
+import resource
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def process_memory():
+    # Resident memory of this process in MB. Without psutil, the peak resident memory is used instead.
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+class PlanBudget:
+    # Bounds the work of planning a single graph, by wall-clock seconds, number of plans, or memory in MB.
+    # Strategies degraded to when the budget runs out are recorded in `degraded`.
+    def __init__(self, seconds=None, plans=None, memory=None):
+        self.seconds = seconds
+        self.plans = plans
+        self.memory = memory
+
+        self.deadline = None
+        self.memory_checked = 0
+        self.degraded = []
+
+    def start(self):
+        self.deadline = time.time() + self.seconds if self.seconds is not None else None
+        self.memory_checked = 0
+        self.degraded = []
+        return self
+
+    def exhausted(self):
+        now = time.time()
+        if self.deadline is not None and now > self.deadline:
+            return "time"
+
+        # Reading the process memory is slow, so it is only checked every 50ms
+        if self.memory is not None and now - self.memory_checked > 0.05:
+            self.memory_checked = now
+            if process_memory() > self.memory:
+                return "memory"
+
+        return None
+
+    def check(self):
+        reason = self.exhausted()
+        if reason:
+            raise BudgetExhausted(reason)
+
+    def degrade(self, reason, strategy):
+        self.degraded.append(reason + ": " + strategy)
+
+    def limit(self, structure):
+        # Linearizations of a plan structure, sampled if there are more than the plans budget,
+        # and cut short when running out of time or memory
+        if self.plans is not None and structure.count() > self.plans:
+            self.degrade("plans", "sampled " + str(self.plans) + " plans")
+            plans = iter(structure.sample(self.plans))
+        else:
+            plans = structure.iter_linearizations()
+
+        for i, plan in enumerate(plans):
+            if i % 1000 == 0 and i > 0:
+                reason = self.exhausted()
+                if reason:
+                    self.degrade(reason, "stopped after " + str(i) + " plans")
+                    return
+            yield plan
@@ -0,0 +1,73 @@
+import zlib
+from bisect import bisect_right
+from itertools import islice
+from typing import Iterable
+
+
+class CompressedPlans:
+    # A list of plans, zlib compressed in blocks of `block_size` plans.
+    # Indexing, slicing and iterating inflate only the blocks they touch. Slices are views over the same blocks.
+    def __init__(self, plans: Iterable[str] = (), block_size=64):
+        self.blocks = []
+        self.offsets = [0]  # Index of the first plan of every block, and the total number of plans
+        plans = iter(plans)
+        while True:
+            block = list(islice(plans, block_size))
+            if len(block) == 0:
+                break
+            self.blocks.append(zlib.compress("\n".join(block).encode("utf-8")))
+            self.offsets.append(self.offsets[-1] + len(block))
+
+        self.start = 0
+        self.stop = self.offsets[-1]
+        self.cache = [None]  # Last inflated block, shared by all views
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = [None]
+        return state
+
+    def view(self, start: int, stop: int):
+        view = CompressedPlans()
+        view.blocks = self.blocks
+        view.offsets = self.offsets
+        view.cache = self.cache
+        view.start = start
+        view.stop = max(start, stop)
+        return view
+
+    def block(self, b: int):
+        if self.cache[0] is None or self.cache[0][0] != b:
+            self.cache[0] = (b, zlib.decompress(self.blocks[b]).decode("utf-8").split("\n"))
+        return self.cache[0][1]
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self.view(self.start + start, self.start + stop)
+
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("plan index out of range")
+
+        i = self.start + k
+        b = bisect_right(self.offsets, i) - 1
+        return self.block(b)[i - self.offsets[b]]
+
+    def __iter__(self):
+        i = self.start
+        while i < self.stop:
+            b = bisect_right(self.offsets, i) - 1
+            block = self.block(b)
+            end = min(self.stop, self.offsets[b + 1])
+            yield from block[i - self.offsets[b]:end - self.offsets[b]]
+            i = end
+
+    def __bool__(self):
+        return len(self) > 0
@@ -1,18 +1,23 @@
-import json
 import pickle
+import random
 import re
 import sys
 import zlib
-from collections import defaultdict
+from array import array
+from collections import defaultdict, Counter
 from enum import Enum
-from functools import lru_cache
+from functools import lru_cache, reduce
+from math import factorial
+from operator import mul, or_
 from itertools import chain, product, permutations, combinations
 from typing import Set, List
+from weakref import WeakValueDictionary
 
 from tqdm import tqdm
 
 from utils.delex import concat_entity
 from utils.memoize import memoize
+from utils.plan_codec import PlanVocabulary
 from utils.time import Time
 import psutil
 
@@ -22,9 +27,105 @@ def readable_edge(e):
     return " ".join(re.sub('(?!^)([A-Z][a-z]+)', r' \1', e.replace("_", " ")).split()).lower()
 
 
-def powerset(iterable):
-    xs = list(iterable)
-    return list(chain.from_iterable(combinations(xs, n) for n in range(len(xs) + 1)))
+def lazy_product(factories):
+    # Like itertools.product, but re-creates every iterable instead of holding it in memory
+    if len(factories) == 0:
+        yield ()
+        return
+
+    for x in factories[0]():
+        for xs in lazy_product(factories[1:]):
+            yield (x,) + xs
+
+
+def multinomial(counts):
+    return factorial(sum(counts)) // reduce(mul, map(factorial, counts), 1)
+
+
+def keeps_classes_order(perm, classes):
+    last = {}
+    for j in perm:
+        if last.get(classes[j], -1) > j:
+            return False
+        last[classes[j]] = j
+    return True
+
+
+def class_orders(classes):
+    # Permutations of range(n) in which indexes of the same class keep their order, in itertools.permutations order.
+    # These are the distinct orders of a multiset, so identical AND children are not permuted among themselves.
+    return [p for p in permutations(range(len(classes))) if keeps_classes_order(p, classes)]
+
+
+def nth_order(classes, k):
+    # The k-th of class_orders(classes), without listing them
+    counts = Counter(classes)
+    pool = list(range(len(classes)))
+    order = []
+    while len(pool) > 0:
+        firsts = [j for j in pool if all(classes[i] != classes[j] for i in pool if i < j)]
+        for j in firsts:
+            counts[classes[j]] -= 1
+            c = multinomial(counts.values())
+            if k < c:
+                order.append(j)
+                pool.remove(j)
+                break
+            k -= c
+            counts[classes[j]] += 1
+    return order
+
+
+def signature(node):
+    # A hashable description of a plan structure, equal for structures with the same linearizations.
+    # Frozensets cache their hash, so comparing signatures of large structures is cheap.
+    if node.sig is None:
+        if isinstance(node, LinearNode):
+            items = {("next", signature(n)) for n in node.next} if node.next is not None else set()
+            node.sig = frozenset({("linear", node.value)} | items)
+        elif node.children is None:
+            node.sig = frozenset({("leaf", node.get_val() if isinstance(node.value, str) else node.value)})
+        elif node.value == NodeType.OR:
+            node.sig = frozenset({("or",)} | {(e, signature(s)) for e, s in node.children})
+        elif node.value == NodeType.AND:
+            counts = Counter((e, signature(s)) for e, s in node.children)
+            node.sig = frozenset({("and",)} | {(e, s, c) for (e, s), c in counts.items()})
+        else:
+            value = node.get_val() if isinstance(node.value, str) else node.value
+            node.sig = frozenset({("node", value)} | {(i, e, signature(s)) for i, (e, s) in enumerate(node.children)})
+    return node.sig
+
+
+def random_indexes(population: int, amount: int):
+    if not 0 <= amount <= population:
+        raise ValueError("Sample larger than population or is negative")
+    if population < sys.maxsize:
+        return random.sample(range(population), amount)
+
+    # range is too long for random.sample, but the sample is tiny in comparison
+    indexes = []
+    seen = set()
+    while len(indexes) < amount:
+        i = random.randrange(population)
+        if i not in seen:
+            seen.add(i)
+            indexes.append(i)
+    return indexes
+
+
+# Plan nodes by their class, value and children. Nodes are hash-consed: a structurally identical node is the same
+# object, in all the plan structures of the process, and lives as long as any of them does. Children are interned
+# before their parents, so keys compare them by identity.
+INTERNED_NODES = WeakValueDictionary()
+
+
+def interned_node(cls, key, value, children):
+    node = INTERNED_NODES.get(key)
+    if node is None:
+        node = object.__new__(cls)
+        node.init(value, children)
+        INTERNED_NODES[key] = node
+    return node
 
 
 class NodeType(Enum):
@@ -36,10 +137,41 @@ class NodeType(Enum):
 
 
 class StructuredNode:
-    def __init__(self, value, children=None):
+    def __new__(cls, value, children=None):
+        if value == NodeType.OR and children is not None and len(children) > 1:
+            # Options with the same linearizations, like splits to the same sentences, are kept once
+            unique = {}
+            for e, s in children:
+                unique.setdefault((e, signature(s)), (e, s))
+            children = list(unique.values())
+
+        key = (cls, value, None if children is None else tuple(children))
+        return interned_node(cls, key, value, children)
+
+    def init(self, value, children):
         self.value = value
         self.children = children
         self.lins = None
+        self.size = None
+        self.sig = None
+        self.classes = None
+
+    def __getnewargs__(self):
+        # Unpickled and copied nodes are interned as well
+        return self.value, self.children
+
+    def and_classes(self):
+        # The first index of an identical child, for every child of an AND node
+        if self.classes is None:
+            keys = [(e, signature(s)) for e, s in self.children]
+            self.classes = tuple(keys.index(k) for k in keys)
+        return self.classes
+
+    def and_orders(self, edges):
+        classes = self.and_classes()
+        if len(set(classes)) == len(classes):
+            return permutations(edges)
+        return [[edges[j] for j in order] for order in class_orders(classes)]
 
     def get_val(self):
         return concat_entity(self.value)
@@ -67,15 +199,113 @@ class StructuredNode:
             return [". ".join(p) for p in edges]
 
         if self.value == NodeType.AND:
-            return [" ".join(p) for e in edges for p in permutations(e)]
+            return [" ".join(p) for e in edges for p in self.and_orders(e)]
 
         return [self.get_val() + " " + " ".join(e) for e in edges]
 
+    def count(self):
+        # Number of linearizations, computed over the structure without enumerating them
+        if self.value == NodeType.FILTER_OUT:
+            return 0
+        if self.size is None:
+            self.size = self.rec_count()
+        return self.size
+
+    def rec_count(self):
+        if self.children is None:
+            return 1
+
+        counts = [s.count() for e, s in self.children]
+
+        if self.value == NodeType.OR:
+            return sum(counts)
+
+        total = reduce(mul, counts, 1)
+
+        if self.value == NodeType.AND:
+            return total * multinomial(Counter(self.and_classes()).values())
+
+        return total
+
+    def linearization(self, i: int):
+        # The i-th linearization, found by walking down the structure using subtree counts
+        if not 0 <= i < self.count():
+            raise IndexError("linearization index out of range")
+
+        if self.children is None:
+            return self.get_val()
+
+        if self.value == NodeType.OR:
+            for e, s in self.children:
+                c = s.count()
+                if i < c:
+                    l = s.linearization(i)
+                    return (e + " [" + l + "]") if e else l
+                i -= c
+
+        if self.value == NodeType.AND:
+            i, perm_i = divmod(i, multinomial(Counter(self.and_classes()).values()))
+
+        edges = []
+        for e, s in reversed(self.children):
+            i, j = divmod(i, s.count())
+            l = s.linearization(j)
+            edges.append((e + " [" + l + "]") if e else l)
+        edges.reverse()
+
+        if self.value == NodeType.SENTENCES:
+            return ". ".join(edges)
+
+        if self.value == NodeType.AND:
+            return " ".join([edges[j] for j in nth_order(self.and_classes(), perm_i)])
+
+        return self.get_val() + " " + " ".join(edges)
+
+    def sample(self, amount: int):
+        return [self.linearization(i) for i in random_indexes(self.count(), amount)]
+
+    def iter_linearizations(self):
+        # Same order as linearizations, without holding the cross-product in memory
+        if self.value == NodeType.FILTER_OUT:
+            return
+        if self.lins:
+            yield from self.lins
+            return
+        if self.children is None:
+            yield self.get_val()
+            return
+
+        edges = [lambda e=e, s=s: ((e + " [" + l + "]") if e else l for l in s.iter_linearizations())
+                 for e, s in self.children]
+
+        if self.value == NodeType.OR:
+            for e in edges:
+                yield from e()
+            return
+
+        for e in lazy_product(edges):
+            if self.value == NodeType.SENTENCES:
+                yield ". ".join(e)
+            elif self.value == NodeType.AND:
+                for p in self.and_orders(e):
+                    yield " ".join(p)
+            else:
+                yield self.get_val() + " " + " ".join(e)
+
 
 class LinearNode:
-    def __init__(self, value, next=None):
+    def __new__(cls, value, next=None):
+        key = (cls, value, None if next is None else tuple(next))
+        return interned_node(cls, key, value, next)
+
+    def init(self, value, next):
         self.value = value
         self.next = next
+        self.size = None
+        self.sig = None
+
+    def __getnewargs__(self):
+        return self.value, self.next
 
     def linearizations(self):
         none_empty = [s for s in self.rec_linearizations() if len(s) > 0]
@@ -90,6 +320,256 @@ class LinearNode:
 
         return [[self.value] + l for n in self.next for l in n.rec_linearizations()]
 
+    def count(self):
+        if self.size is None:
+            if self.next is None:
+                self.size = 0 if self.value == NodeType.FILTER_OUT else 1
+            else:
+                self.size = sum(n.count() for n in self.next)
+        return self.size
+
+    def linearization(self, i: int):
+        if not 0 <= i < self.count():
+            raise IndexError("linearization index out of range")
+
+        path = []
+        node = self
+        while node.next is not None:
+            if node.value != NodeType.OR:
+                path.append(node.value)
+            for n in node.next:
+                c = n.count()
+                if i < c:
+                    node = n
+                    break
+                i -= c
+        return " ".join(path)
+
+    def sample(self, amount: int):
+        return [self.linearization(i) for i in random_indexes(self.count(), amount)]
+
+    def iter_linearizations(self):
+        # Same order as linearizations, walking a single path at a time
+        for path, last in self.rec_iter_linearizations([]):
+            if last != NodeType.FILTER_OUT:
+                yield " ".join(path)
+
+    def rec_iter_linearizations(self, path):
+        if self.next is None:
+            yield path, self.value
+            return
+
+        if self.value != NodeType.OR:
+            path.append(self.value)
+
+        for n in self.next:
+            yield from n.rec_iter_linearizations(path)
+
+        if self.value != NodeType.OR:
+            path.pop()
+
+
+# Partial plans, for searching the plan structures without enumerating them.
+# A partial plan is a linked stack of frames still to be emitted: literal strings, StructuredNodes,
+# (LinearNode, leading space) pairs, and ("and", remaining children, is first) permutations in progress.
+
+def push_frames(stack, frames):
+    for f in reversed(frames):
+        stack = (f, stack)
+    return stack
+
+
+def labelled_frames(e, s):
+    return [e + " [", s, "]"] if e else [s]
+
+
+def joined_frames(children, sep):
+    frames = []
+    for i, (e, s) in enumerate(children):
+        if i > 0:
+            frames.append(sep)
+        frames += labelled_frames(e, s)
+    return frames
+
+
+def plan_choices(stack):
+    # Emits plan pieces up to the next choice in the structure.
+    # Returns the pieces, and a stack per option. A None option means the plan is complete.
+    pieces = []
+    while stack is not None:
+        frame, stack = stack
+
+        if isinstance(frame, str):
+            pieces.append(frame)
+
+        elif isinstance(frame, StructuredNode):
+            if frame.value == NodeType.FILTER_OUT:
+                return pieces, []
+            if frame.children is None:
+                pieces.append(frame.get_val())
+            elif frame.value == NodeType.OR:
+                return pieces, [push_frames(stack, labelled_frames(e, s)) for e, s in frame.children]
+            elif frame.value == NodeType.SENTENCES:
+                stack = push_frames(stack, joined_frames(frame.children, ". "))
+            elif frame.value == NodeType.AND:
+                stack = (("and", tuple(frame.children), True), stack)
+            else:
+                pieces.append(frame.get_val() + " ")
+                stack = push_frames(stack, joined_frames(frame.children, " "))
+
+        elif isinstance(frame, LinearNode):
+            stack = ((frame, False), stack)
+
+        elif frame[0] == "and":
+            _, remaining, first = frame
+            if len(remaining) > 0:
+                # Of identical children, only the first remaining one can come next
+                keys = [(e, signature(s)) for e, s in remaining]
+                return pieces, [push_frames(stack, ([] if first else [" "]) + labelled_frames(*remaining[i]) +
+                                            [("and", remaining[:i] + remaining[i + 1:], False)])
+                                for i in range(len(remaining)) if keys.index(keys[i]) == i]
+
+        else:
+            node, lead = frame
+            if node.next is None:
+                if node.value == NodeType.FILTER_OUT:
+                    return pieces, []
+                continue
+
+            if node.value != NodeType.OR:
+                pieces.append(" " + node.value if lead else node.value)
+                lead = True
+
+            if len(node.next) != 1:
+                return pieces, [((n, lead), stack) for n in node.next]
+            stack = ((node.next[0], lead), stack)
+
+    return pieces, [None]
+
+
+def frame_bounds(frame, piece_bound, cache):
+    # (min #relations, max #relations, max sum of relation bounds) over the completions of a frame.
+    # None if the frame can not be completed. piece_bound gives (#relations, bound) of a literal piece.
+    if isinstance(frame, str):
+        relations, bound = piece_bound(frame)
+        return relations, relations, bound
+
+    if isinstance(frame, tuple) and frame[0] == "and":
+        return combine_bounds([labelled_bounds(e, s, piece_bound, cache) for e, s in frame[1]])
+
+    node = frame[0] if isinstance(frame, tuple) else frame
+    if id(node) not in cache:
+        cache[id(node)] = (node, node_bounds(node, piece_bound, cache))
+    return cache[id(node)][1]
+
+
+def combine_bounds(bounds, any_of=False):
+    if any_of:
+        bounds = [b for b in bounds if b is not None]
+        if len(bounds) == 0:
+            return None
+        return min(b[0] for b in bounds), max(b[1] for b in bounds), max(b[2] for b in bounds)
+
+    if None in bounds:
+        return None
+    return sum(b[0] for b in bounds), sum(b[1] for b in bounds), sum(b[2] for b in bounds)
+
+
+def node_bounds(node, piece_bound, cache):
+    if isinstance(node, LinearNode):
+        if node.next is None:
+            return None if node.value == NodeType.FILTER_OUT else (0, 0, 0)
+        own = frame_bounds(node.value, piece_bound, cache) if node.value != NodeType.OR else (0, 0, 0)
+        return combine_bounds([own, combine_bounds([frame_bounds((n, True), piece_bound, cache)
+                                                    for n in node.next], any_of=True)])
+
+    if node.value == NodeType.FILTER_OUT:
+        return None
+    if node.children is None:
+        return 0, 0, 0
+
+    children = [labelled_bounds(e, s, piece_bound, cache) for e, s in node.children]
+    return combine_bounds(children, any_of=node.value == NodeType.OR)
+
+
+def labelled_bounds(e, s, piece_bound, cache):
+    if not e:
+        return frame_bounds(s, piece_bound, cache)
+    return combine_bounds([frame_bounds(e + " [", piece_bound, cache), frame_bounds(s, piece_bound, cache)])
+
+
+def stack_bounds(stack, piece_bound, cache):
+    bounds = []
+    while stack is not None:
+        frame, stack = stack
+        bounds.append(frame_bounds(frame, piece_bound, cache))
+    return combine_bounds(bounds)
+
+
+def split_choice(node):
+    # Splits a structure by its first choice, to structures whose linearizations, one after the other,
+    # are the structure's linearizations. None if there is no choice to split by.
+    if isinstance(node, LinearNode):
+        if node.next is None:
+            return None
+        if len(node.next) > 1:
+            return [LinearNode(node.value, [n]) for n in node.next]
+        parts = split_choice(node.next[0])
+        return [LinearNode(node.value, [p]) for p in parts] if parts else None
+
+    if node.children is None:
+        return None
+    if node.value == NodeType.OR:
+        if len(node.children) > 1:
+            return [StructuredNode(NodeType.OR, [c]) for c in node.children]
+        e, s = node.children[0]
+        parts = split_choice(s)
+        return [StructuredNode(NodeType.OR, [(e, p)]) for p in parts] if parts else None
+    if node.value == NodeType.SENTENCES:
+        # The first sentence is the outer loop of the sentences product
+        (e, s), rest = node.children[0], node.children[1:]
+        parts = split_choice(s)
+        return [StructuredNode(NodeType.SENTENCES, [(e, p)] + rest) for p in parts] if parts else None
+    return None
+
+
+def group_parts(parts, amount: int):
+    # Joins consecutive parts to up to `amount` parts with about the same number of linearizations
+    total = sum(p.count() for p in parts)
+    groups = [[]]
+    size = 0
+    for p in parts:
+        if len(groups[-1]) > 0 and len(groups) < amount and size >= total * len(groups) / amount:
+            groups.append([])
+        groups[-1].append(p)
+        size += p.count()
+
+    if isinstance(parts[0], LinearNode):
+        return [g[0] if len(g) == 1 else LinearNode(NodeType.OR, g) for g in groups]
+    return [g[0] if len(g) == 1 else StructuredNode(NodeType.OR, [("", p) for p in g]) for g in groups]
+
+
+def shards(structure, amount: int):
+    # Splits the largest shards by their choices, until there are `amount` shards or none can be split.
+    # A choice with more options than shards left to make is split to groups of its options.
+    # Linearizations of the shards, one after the other, are the structure's linearizations.
+    parts = [structure]
+    done = set()
+    while len(parts) < amount:
+        candidates = [i for i in range(len(parts)) if i not in done]
+        if len(candidates) == 0:
+            break
+        i = max(candidates, key=lambda i: parts[i].count())
+        split = split_choice(parts[i])
+        if split is None:
+            done.add(i)
+            continue
+        if len(parts) - 1 + len(split) > amount:
+            split = group_parts(split, amount - len(parts) + 1)
+        parts[i:i + 1] = split
+        done = {j if j < i else j + len(split) - 1 for j in done}
+    return parts
+
 
 class Graph:
     def __init__(self, rdfs=[]):
@@ -97,6 +577,9 @@ class Graph:
         self.edges = defaultdict(list)
         self.undirected_edges = defaultdict(list)
         self.nodes = set()
+        self.compacted = None
+        self.key = None
+        self.hash = None
 
         for s, r, o in rdfs:
             self.add_edge(s, o, r)
@@ -111,14 +594,397 @@ class Graph:
         self.nodes.add(s)
         self.nodes.add(o)
 
+        self.compacted = None
+        self.key = None
+        self.hash = None
+
     def as_rdf(self):
         return [(n1, e, n2) for ((n1, n2), es) in self.edges.items() for e in es]
 
+    def unique_key(self):
+        if getattr(self, "key", None) is None:
+            self.key = tuple(self.as_rdf())
+        return self.key
+
+    def __hash__(self):
+        if getattr(self, "hash", None) is None:
+            self.hash = hash(self.unique_key())
+        return self.hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Graph):
+            return False
+        return self.unique_key() == other.unique_key()
+
+    def __getstate__(self):
+        # Strings hashes are salted per process, so the hash is not pickled
+        state = dict(self.__dict__)
+        state["hash"] = None
+        return state
+
+    def compact(self):
+        if getattr(self, "compacted", None) is None:
+            self.compacted = CompactGraph.from_rdf(self.as_rdf())
+        return self.compacted
+
+    def exhaustive_plan(self, force_tree=False, cache=None, budget=None):
+        return self.sub_graphs_plan(cache=cache, force_tree=force_tree, budget=budget)
+
+    def constraint_graphs_plan(self, constraints):
+        return self.compact().constraint_graphs_plan(constraints)
+
+    def constraint_graphs_maker(self, components):
+        return self.compact().constraint_graphs_maker(components)
+
+    def sub_graphs_plan(self, max_size=4, cache=None, force_tree=False, budget=None):
+        return self.compact().sub_graphs_plan(max_size, cache, force_tree=force_tree, budget=budget)
+
+    def plan_all(self, force_tree=False):
+        return self.compact().plan_all(force_tree=force_tree)
+
+    def plan_from(self, node):
+        compact = self.compact()
+        return compact.plan_from(compact.nodes.index(node))
+
+    def traverse_all(self):
+        return self.compact().traverse_all()
+
+    def decompose(self, max_size: int):
+        compact = self.compact()
+        return [compact.sub_graph(edges).to_graph() for edges in compact.decompose(max_size)]
+
+    def canonical(self):
+        graph, slots = self.compact().canonical()
+        return graph.to_graph(), slots
+
+
+class GraphRegistry:
+    # Interns graphs, so identical RDF sets share one Graph, with its key and hash computed once.
+    # Interned graphs are shared, and should not be changed.
+    def __init__(self):
+        self.graphs = {}
+        self.rdfs = {}
+
+    def get(self, rdfs):
+        rdfs = tuple(map(tuple, rdfs))
+        if rdfs not in self.rdfs:
+            g = Graph(rdfs)
+            self.rdfs[rdfs] = self.graphs.setdefault(g, g)
+        return self.rdfs[rdfs]
+
+
+def slot_entity(i: int):
+    return "SLOT" + str(i)
+
+
+def fill_slots(plan: str, slots):
+    # Instantiates a plan of a canonical graph with the entities of the slots
+    return re.sub("ENT_SLOT(\\d+)_ENT", lambda m: concat_entity(slots[int(m.group(1))]), plan)
+
+
+def mask_edges(mask: int):
+    edges = []
+    while mask:
+        low = mask & -mask
+        edges.append(low.bit_length() - 1)
+        mask ^= low
+    return tuple(edges)
+
+
+def mask_bits(mask: int, bits):
+    # Translates a local edges bitmask to a global one
+    return reduce(or_, (bits[e] for e in mask_edges(mask)), 0)
+
+
+class PlanCache:
+    # Plans of sub-graphs, shared between all the graphs planned with it.
+    # Triples are interned to global ids, and a sub-graph is keyed by the bitmask of its triples.
+    # A cache should only be used with one max_size and force_tree.
+    def __init__(self):
+        self.triples = {}
+        self.plans = {}  # plan_all of a sub-graph
+        self.sub_plans = {}  # sub_graphs_plan of a sub-graph
+
+    def triple_bits(self, graph):
+        rdfs = graph.as_rdf()
+        return {e: 1 << self.triples.setdefault(t, len(self.triples)) for e, t in zip(graph.edges, rdfs)}
+
+    def plan(self, key: int, make):
+        if key not in self.plans:
+            self.plans[key] = make()
+        return self.plans[key]
+
+
+class CompactGraph:
+    # Nodes and relations are interned to ints, edges are kept in arrays with a CSR incidence index.
+    # A sub-graph shares all of these with its root graph, and only keeps which root edges it includes.
+    __slots__ = ("nodes", "relations", "sources", "labels", "targets", "offsets", "incidence",
+                 "edges", "mask", "order", "adjacency", "hash")
+
+    def __init__(self, nodes, relations, sources, labels, targets, offsets, incidence, edges):
+        self.nodes = nodes
+        self.relations = relations
+        self.sources = sources
+        self.labels = labels
+        self.targets = targets
+        self.offsets = offsets
+        self.incidence = incidence  # Per node, 2 * edge for outgoing edges, 2 * edge + 1 for incoming ones
+
+        self.edges = edges
+        self.mask = sum(1 << e for e in edges)
+        self.order = None
+        self.adjacency = None
+        self.hash = None
+
+    @staticmethod
+    def from_rdf(rdfs):
+        # Edges are grouped by (subject, object) like Graph.as_rdf. A triple stated twice is a single edge.
+        grouped = defaultdict(list)
+        for s, r, o in dict.fromkeys(map(tuple, rdfs)):
+            grouped[(s, o)].append(r)
+        rdfs = [(s, r, o) for (s, o), rs in grouped.items() for r in rs]
+
+        node_ids = {}
+        relation_ids = {}
+        for s, r, o in rdfs:
+            node_ids.setdefault(s, len(node_ids))
+            node_ids.setdefault(o, len(node_ids))
+            relation_ids.setdefault(r, len(relation_ids))
+
+        sources = array("i", [node_ids[s] for s, r, o in rdfs])
+        labels = array("i", [relation_ids[r] for s, r, o in rdfs])
+        targets = array("i", [node_ids[o] for s, r, o in rdfs])
+
+        incident = [[] for _ in node_ids]
+        for e in range(len(rdfs)):
+            incident[sources[e]].append(2 * e)
+            incident[targets[e]].append(2 * e + 1)
+
+        offsets = array("i", [0])
+        for i in incident:
+            offsets.append(offsets[-1] + len(i))
+        incidence = array("i", chain.from_iterable(incident))
+
+        return CompactGraph(tuple(node_ids), tuple(relation_ids), sources, labels, targets, offsets, incidence,
+                            tuple(range(len(rdfs))))
+
+    def sub_graph(self, edges):
+        return CompactGraph(self.nodes, self.relations, self.sources, self.labels, self.targets,
+                            self.offsets, self.incidence, tuple(edges))
+
+    def relabel(self, node_f, relation_f):
+        nodes = [node_f(n) for n in self.nodes]
+        relations = [relation_f(r) for r in self.relations]
+        return CompactGraph.from_rdf([(nodes[self.sources[e]], relations[self.labels[e]], nodes[self.targets[e]])
+                                      for e in self.edges])
+
+    def node_order(self):
+        # Node ids, by first appearance like Graph.graph
+        if self.order is None:
+            order = {}
+            for e in self.edges:
+                order.setdefault(self.sources[e], None)
+                order.setdefault(self.targets[e], None)
+            self.order = tuple(order)
+        return self.order
+
+    def incident(self, node):
+        # (edge, neighbor, direction) of the edges of this graph touching a node, in edge order
+        for i in self.incidence[self.offsets[node]:self.offsets[node + 1]]:
+            e = i >> 1
+            if self.mask >> e & 1:
+                yield (e, self.targets[e], ">") if i & 1 == 0 else (e, self.sources[e], "<")
+
+    def as_rdf(self):
+        return [(self.nodes[self.sources[e]], self.relations[self.labels[e]], self.nodes[self.targets[e]])
+                for e in self.edges]
+
     def unique_key(self):
         return tuple(self.as_rdf())
 
-    def exhaustive_plan(self, force_tree=False):
-        return self.sub_graphs_plan(force_tree=force_tree)
+    def to_graph(self):
+        return Graph(self.as_rdf())
+
+    def __hash__(self):
+        if self.hash is None:
+            self.hash = hash(self.unique_key())
+        return self.hash
+
+    def __getstate__(self):
+        # Strings hashes are salted per process, so the hash is not pickled
+        return {s: getattr(self, s) for s in self.__slots__ if s != "hash"}
+
+    def __setstate__(self, state):
+        for s in self.__slots__:
+            setattr(self, s, state.get(s))
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactGraph):
+            return False
+        if self.nodes is other.nodes and self.relations is other.relations:
+            return self.edges == other.edges
+        return self.unique_key() == other.unique_key()
+
+    def refine(self, colors):
+        # Color refinement: splits nodes of a color by their colored neighborhoods, until no color splits.
+        # Colors are ranks of sorted signatures, so isomorphic graphs get the same colors.
+        while True:
+            signatures = {n: (colors[n], tuple(sorted((d, self.relations[self.labels[e]], colors[neighbor])
+                                                      for e, neighbor, d in self.incident(n))))
+                          for n in colors}
+            ranks = {sig: i for i, sig in enumerate(sorted(set(signatures.values())))}
+            refined = {n: ranks[signatures[n]] for n in colors}
+            if len(ranks) == len(set(colors.values())):
+                return refined
+            colors = refined
+
+    def twins(self):
+        # The first of every node's twins: nodes with the same edges to the same neighbors, like the leaves of a star
+        # with a single relation. Swapping two twins maps the graph onto itself.
+        first = {}
+        return {n: first.setdefault(tuple(sorted((d, self.labels[e], neighbor)
+                                                 for e, neighbor, d in self.incident(n))), n)
+                for n in self.node_order()}
+
+    def canonical(self, max_leaves=1000):
+        # Relabels the nodes to slots, by the nodes order giving the smallest edges list, so isomorphic graphs
+        # (up to entities) get the same graph. Orders are searched by individualization-refinement: a node of the
+        # first color shared by several nodes gets a color of its own, and colors are refined again, until every
+        # node has its own color. Of twins, only one is tried, as all of them lead to the same orders.
+        # If the search reaches more than max_leaves orders, the graph keeps its own nodes order, which is correct,
+        # but not shared by isomorphic graphs. Returns the graph, and the node of every slot.
+        twins = self.twins()
+        best = None
+        leaves = 0
+        stack = [self.refine({n: 0 for n in self.node_order()})]
+        while len(stack) > 0 and leaves <= max_leaves:
+            colors = stack.pop()
+            sizes = Counter(colors.values())
+            if len(sizes) == len(colors):
+                leaves += 1
+                key = sorted((colors[self.sources[e]], self.relations[self.labels[e]], colors[self.targets[e]])
+                             for e in self.edges)
+                if best is None or key < best[0]:
+                    best = key, sorted(colors, key=colors.get)
+                continue
+
+            target = min(c for c, size in sizes.items() if size > 1)
+            representatives = {}
+            for n in colors:
+                if colors[n] == target:
+                    representatives.setdefault(twins[n], n)
+            stack += [self.refine({**colors, n: -1}) for n in reversed(list(representatives.values()))]
+
+        if leaves > max_leaves:
+            order = list(self.node_order())
+            slot = {n: i for i, n in enumerate(order)}
+            key = [(slot[self.sources[e]], self.relations[self.labels[e]], slot[self.targets[e]]) for e in self.edges]
+        else:
+            key, order = best
+
+        graph = CompactGraph.from_rdf([(slot_entity(s), r, slot_entity(o)) for s, r, o in key])
+        return graph, tuple(self.nodes[n] for n in order)
+
+    def has_cycle(self):
+        # Of a connected graph. Two edges between the same nodes, in any direction, are a cycle as well.
+        # Disconnected graphs have no plans either way.
+        return len(self.edges) >= len(self.node_order())
+
+    def blocks(self):
+        # Biconnected components, as bitmasks of edges. Edges between the same two nodes make a cycle, so they are
+        # always in one block, and a self loop is a block of its own.
+        disc = {}
+        low = {}
+        edges_stack = []
+        blocks = []
+        for root in self.node_order():
+            if root in disc:
+                continue
+            disc[root] = low[root] = len(disc)
+            dfs = [(root, None, self.incident(root))]
+            while len(dfs) > 0:
+                node, parent_edge, incident = dfs[-1]
+                for e, n, d in incident:
+                    if e == parent_edge:
+                        continue
+                    if n == node:
+                        if d == ">":
+                            blocks.append(1 << e)
+                    elif n not in disc:
+                        edges_stack.append(e)
+                        disc[n] = low[n] = len(disc)
+                        dfs.append((n, e, self.incident(n)))
+                        break
+                    elif disc[n] < disc[node]:
+                        edges_stack.append(e)
+                        low[node] = min(low[node], disc[n])
+                else:
+                    dfs.pop()
+                    if len(dfs) > 0:
+                        parent = dfs[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                        if low[node] >= disc[parent]:
+                            # The parent is an articulation point, or the root, so the block is complete
+                            block = 0
+                            while True:
+                                e = edges_stack.pop()
+                                block |= 1 << e
+                                if e == parent_edge:
+                                    break
+                            blocks.append(block)
+        return sorted(blocks, key=lambda m: m & -m)
+
+    def decompose(self, max_size: int):
+        # Splits the graph to connected parts of up to max_size edges, for planning every part on its own.
+        # Parts are biconnected blocks, where larger blocks are split by growing parts breadth first,
+        # and adjacent small parts are merged, smallest first, as long as they fit.
+        adjacent = self.edge_adjacency()
+
+        def neighborhood(part):
+            touching = 0
+            for e in mask_edges(part):
+                touching |= adjacent[e]
+            return touching & self.mask & ~part
+
+        parts = []
+        for block in self.blocks():
+            if bin(block).count("1") <= max_size:
+                parts.append(block)
+                continue
+            while block:
+                part = block & -block
+                queue = [part.bit_length() - 1]
+                size = 1
+                while len(queue) > 0 and size < max_size:
+                    new = adjacent[queue.pop(0)] & block & ~part
+                    while new and size < max_size:
+                        low = new & -new
+                        new ^= low
+                        part |= low
+                        queue.append(low.bit_length() - 1)
+                        size += 1
+                parts.append(part)
+                block &= ~part
+
+        while True:
+            merged = False
+            for part in sorted(parts, key=lambda p: (bin(p).count("1"), p & -p)):
+                touching = neighborhood(part)
+                options = [p for p in parts if p & touching and bin(p | part).count("1") <= max_size]
+                if len(options) > 0:
+                    other = min(options, key=lambda p: (bin(p).count("1"), p & -p))
+                    parts = [p for p in parts if p != part and p != other] + [part | other]
+                    merged = True
+                    break
+            if not merged:
+                break
+
+        return [mask_edges(p) for p in sorted(parts, key=lambda m: m & -m)]
+
+    def exhaustive_plan(self, force_tree=False, cache=None, budget=None):
+        return self.sub_graphs_plan(cache=cache, force_tree=force_tree, budget=budget)
 
     def constraint_graphs_plan(self, constraints):
         options = self.constraint_graphs_maker(constraints)
@@ -132,129 +998,213 @@ class Graph:
         if not prev:
             prev = []
 
-        lengths = [len(self.nodes), len(components)]
+        lengths = [len(self.node_order()), len(components)]
         if all(map(lambda a: a == 0, lengths)):  # If both lengths are 0
             return [prev]
 
         if min(lengths) == 0 and max(lengths) > 0:  # If it cannot be satisfied
             return []
 
+        # Every node a component must include needs an edge it may take, in this graph for the first component,
+        # and in the complement for the ones after it
+        required = [self.required_masks(comp) for comp in components]
+        if any(m is None for m in required):
+            return []
+
         comp = components[0]
+        allowed = [e for e in self.edges
+                   if len(comp["must_exclude"].intersection((self.nodes[self.sources[e]],
+                                                             self.nodes[self.targets[e]]))) == 0]
 
-        rdfs = self.as_rdf()
+        # The last component takes all the edges, and every other component leaves at least one for each after it
+        rest = len(components) - 1
+        min_size = len(self.edges) if rest == 0 else max(1, (len(required[0]) + 1) // 2)
+        max_size = min(len(allowed), len(self.edges) - rest)
 
         options = []
 
-        for g in map(list, powerset(rdfs)):
-            if len(g) == 0:  # Skip empty graphs
-                continue
-
-            g_nodes = set(chain.from_iterable([[s, o] for s, r, o in g]))
-            if comp["must_include"] <= g_nodes and len(comp["must_exclude"].intersection(g_nodes)) == 0:
-                complement = Graph([r for r in rdfs if r not in g])
-                options += complement.constraint_graphs_maker(components[1:], prev + [Graph(g)])
-
-        return options
-
-    def sub_graphs_plan(self, max_size=4, plan_cache=None, graph_plan_cache=None, force_tree=False):
-        if not plan_cache:
-            plan_cache = {}
-        if not graph_plan_cache:
-            graph_plan_cache = {}
+        for size in range(min_size, max_size + 1):
+            for g in combinations(allowed, size):
+                g_mask = sum(1 << e for e in g)
+                if not all(g_mask & m for m in required[0]):
+                    continue
 
-        rdfs = self.as_rdf()
-        sub_graphs = [list(p) for p in powerset(rdfs) if max_size >= len(p) > 0 and len(p) != len(rdfs)]
+                complement_mask = self.mask & ~g_mask
+                if not all(complement_mask & m for masks in required[1:] for m in masks):
+                    continue
 
-        g_s = json.dumps(rdfs)
-        if g_s not in plan_cache:
-            plan_cache[g_s] = self.plan_all(force_tree=force_tree)
-        options = [plan_cache[g_s]]
+                complement = self.sub_graph([e for e in self.edges if not g_mask >> e & 1])
+                options += complement.constraint_graphs_maker(components[1:], prev + [self.sub_graph(g)])
 
-        for g1 in sub_graphs:
-            g2 = [r for r in rdfs if r not in g1]
-
-            g1_s = json.dumps(g1)
-            g2_s = json.dumps(g2)
-
-            if g1_s not in plan_cache:
-                plan_cache[g1_s] = Graph(g1).plan_all(force_tree=force_tree)
-            if g2_s not in graph_plan_cache:
-                graph_plan_cache[g2_s] = Graph(g2).sub_graphs_plan(max_size, plan_cache, graph_plan_cache)
-
-            options.append(
-                StructuredNode(NodeType.SENTENCES, [("", plan_cache[g1_s]), ("", graph_plan_cache[g2_s])]))
+        return options
 
-        return StructuredNode(NodeType.OR, [("", o) for o in options])
+    def required_masks(self, comp):
+        # For each node a component must include, the mask of the edges touching it the component may take
+        node_ids = {n: i for i, n in enumerate(self.nodes)}
+        masks = []
+        for n in comp["must_include"]:
+            if n not in node_ids or n in comp["must_exclude"]:
+                return None
+            mask = 0
+            for e, neighbor, _ in self.incident(node_ids[n]):
+                if self.nodes[neighbor] not in comp["must_exclude"]:
+                    mask |= 1 << e
+            if mask == 0:
+                return None
+            masks.append(mask)
+        return masks
+
+    def sub_graphs_plan(self, max_size=4, cache=None, force_tree=False, budget=None):
+        # Raises BudgetExhausted if the budget runs out before the plan is built
+        if cache is None:
+            cache = PlanCache()
+
+        bits = cache.triple_bits(self)
+        return self.rec_sub_graphs_plan(self.mask, max_size, cache, bits, force_tree, budget)
+
+    def edge_adjacency(self):
+        # Per root edge, the bitmask of the other edges sharing a node with it
+        if self.adjacency is None:
+            self.adjacency = []
+            for e in range(len(self.sources)):
+                touching = 0
+                for n in (self.sources[e], self.targets[e]):
+                    for i in self.incidence[self.offsets[n]:self.offsets[n + 1]]:
+                        touching |= 1 << (i >> 1)
+                self.adjacency.append(touching & ~(1 << e))
+        return self.adjacency
+
+    def connected_sub_graphs(self, mask, max_size):
+        # Bitmasks of the connected sub-graphs of up to max_size edges, in the order of powerset: by size, then by
+        # their edges. Every sub-graph is grown from its smallest edge, adding edges that touch it and are not yet
+        # next to it, so each one is made once, and disconnected ones are never made.
+        adjacent = self.edge_adjacency()
+        sub_graphs = []
+
+        def extend(sub_mask, size, extension, neighborhood, above):
+            sub_graphs.append(sub_mask)
+            if size == max_size:
+                return
+            while extension:
+                low = extension & -extension
+                extension ^= low
+                e = low.bit_length() - 1
+                new = adjacent[e] & above & ~neighborhood
+                extend(sub_mask | low, size + 1, extension | new, neighborhood | adjacent[e], above)
+
+        for seed in mask_edges(mask):
+            above = mask & ~((2 << seed) - 1)
+            extend(1 << seed, 1, adjacent[seed] & above, (adjacent[seed] & mask) | (1 << seed), above)
+
+        # Edge tuples of the same size are ordered by their smallest differing edge, which is the highest
+        # differing bit of the bit reversed masks
+        width = mask.bit_length()
+        return sorted(sub_graphs, key=lambda m: (bin(m).count("1"), -int(format(m, "0%db" % width)[::-1], 2)))
+
+    def rec_sub_graphs_plan(self, mask, max_size, cache, bits, force_tree, budget=None):
+        # Sub-graphs are local bitmasks over the root edges, and are cached by their global triples bitmask
+        key = mask_bits(mask, bits)
+        if key in cache.sub_plans:
+            return cache.sub_plans[key]
+
+        if budget is not None:
+            budget.check()
+
+        edges = mask_edges(mask)
+        # A sentence must be connected to have a plan, so only connected sub-graphs are split off
+        sub_graphs = [m for m in self.connected_sub_graphs(mask, max_size) if m != mask]
+
+        options = [cache.plan(key, lambda: self.sub_graph(edges).plan_all(force_tree=force_tree))]
+
+        for g1_mask in sub_graphs:
+            g1 = mask_edges(g1_mask)
+            g2_mask = mask & ~g1_mask
+
+            g1_plan = cache.plan(mask_bits(g1_mask, bits), lambda: self.sub_graph(g1).plan_all(force_tree=force_tree))
+            g2_plan = self.rec_sub_graphs_plan(g2_mask, max_size, cache, bits, force_tree, budget)
+
+            options.append(StructuredNode(NodeType.SENTENCES, [("", g1_plan), ("", g2_plan)]))
+
+        cache.sub_plans[key] = StructuredNode(NodeType.OR, [("", o) for o in options])
+        return cache.sub_plans[key]
 
     def plan_all(self, force_tree=False):
         # If not a tree, very simple heuristic
-        if not force_tree and any([len(es) > 1 for es in self.edges.values()]):
+        if not force_tree and self.has_cycle():
             return self.traverse_all()
         # More simple traversal only if tree
-        return StructuredNode(NodeType.OR, [("", self.plan_from(node)) for node in self.nodes])
+        return StructuredNode(NodeType.OR, [("", self.plan_from(node)) for node in self.node_order()])
 
-    def plan_from(self, node):
+    def plan_from(self, node: int):
         visited = set()
         plan = self.dfs(node, visited)
 
         # If there is more than 1 connected component
-        if len(visited) != len(self.nodes):
+        if len(visited) != len(self.node_order()):
             return StructuredNode(NodeType.FILTER_OUT)
 
         return plan
 
-    def dfs(self, node: str, visited: Set[str]):
+    def dfs(self, node: int, visited: Set[int]):
         if node in visited:
             return None
 
         visited.add(node)
 
-        children = [(self.undirected_edges[(node, n)], self.dfs(n, visited)) for n in self.graph[node]]
+        # Edges are grouped by neighbor, by the neighbor's first appearance
+        neighbors = defaultdict(list)
+        for e, n, d in self.incident(node):
+            neighbors[n].append(d + " " + self.relations[self.labels[e]])
+
+        children = [(es, self.dfs(n, visited)) for n, es in neighbors.items()]
         children = [(readable_edge(e), n) for (es, n) in children for e in es if n]
 
         children = [("", StructuredNode(NodeType.AND, children))] if len(children) > 0 else []
 
-        return StructuredNode(node, children)
-
-    def traverse_all(self, nodes_stack=None, rdfs=None):
-        if nodes_stack is None:
-            rdfs = self.as_rdf()
-            return LinearNode(NodeType.OR,
-                              [LinearNode(concat_entity(n), self.traverse_all([n], rdfs)) for n in self.nodes])
-
-        f_edges = [(i, n2, ">", e) for i, (n1, e, n2) in enumerate(rdfs) if n1 == nodes_stack[-1]]
-        b_edges = [(i, n1, "<", e) for i, (n1, e, n2) in enumerate(rdfs) if n2 == nodes_stack[-1]]
-        edges = f_edges + b_edges
-
-        options = []
-        for i, n, d, e in edges:
-            new_rdfs = list(rdfs)
-            new_rdfs.pop(i)
-            text = " ".join([d, readable_edge(e), "[", concat_entity(n)])
-            options.append(LinearNode(text, self.traverse_all(nodes_stack + [n], new_rdfs)))
-
-        if len(nodes_stack) > 1:
-            options.append(LinearNode("]", self.traverse_all(nodes_stack[:-1], rdfs)))
-
-        if len(options) > 0:
-            return options
-
-        if len(rdfs) == 0:
-            return [LinearNode(NodeType.FINAL)]
-        return [LinearNode(NodeType.FILTER_OUT)]
-
-
-class Compressor:
-    def __init__(self):
-        self.voc = {}
-
-    def compress(self, plan: str):
-        tokens = []
-        for t in plan.split():
-            if t not in self.voc:
-                self.voc[t] = len(self.voc)
-            tokens.append(chr(self.voc[t]))
-        return "".join(tokens)
+        return StructuredNode(self.nodes[node], children)
+
+    def traverse_all(self):
+        # Traversal states are (nodes stack, remaining edges mask). Steps with the same text from a set of states
+        # lead to the set of their next states, so the plan is a deterministic DAG, where every distinct
+        # plan is a single path. Sets of states are memoized.
+        cache = {}
+        starts = defaultdict(set)
+        for n in self.node_order():
+            starts[concat_entity(self.nodes[n])].add(((n,), self.mask))
+        return LinearNode(NodeType.OR, [LinearNode(text, self.rec_traverse_all(frozenset(states), cache))
+                                        for text, states in starts.items()])
+
+    def rec_traverse_all(self, states, cache):
+        if states in cache:
+            return cache[states]
+
+        steps = defaultdict(set)
+        final = False
+        for nodes_stack, mask in sorted(states):
+            node = nodes_stack[-1]
+            incident = [i for i in self.incidence[self.offsets[node]:self.offsets[node + 1]] if mask >> (i >> 1) & 1]
+            f_edges = [(self.targets[i >> 1], ">", i >> 1) for i in incident if i & 1 == 0]
+            b_edges = [(self.sources[i >> 1], "<", i >> 1) for i in incident if i & 1 == 1]
+
+            for n, d, e in f_edges + b_edges:
+                text = " ".join([d, readable_edge(self.relations[self.labels[e]]), "[", concat_entity(self.nodes[n])])
+                steps[text].add((nodes_stack + (n,), mask & ~(1 << e)))
+
+            if len(nodes_stack) > 1:
+                steps["]"].add((nodes_stack[:-1], mask))
+            elif mask == 0:
+                final = True
+
+        options = [LinearNode(text, self.rec_traverse_all(frozenset(next_states), cache))
+                   for text, next_states in steps.items()]
+
+        if final:
+            options.append(LinearNode(NodeType.FINAL))
+        elif len(options) == 0:
+            options = [LinearNode(NodeType.FILTER_OUT)]
+
+        cache[states] = options
+        return options
 
 
 if __name__ == "__main__":
@@ -268,6 +1218,10 @@ if __name__ == "__main__":
     g.add_edge('D', 'E', 'e')
     g.add_edge('A', 'E', 'e')
 
+    now = Time.now()
+    print("exhaustive_plan count", g.exhaustive_plan(force_tree=False).count())
+    print(Time.passed(now))
+
     now = Time.now()
     plans = list(g.exhaustive_plan(force_tree=False).linearizations())
 
@@ -281,12 +1235,9 @@ if __name__ == "__main__":
     compressed = zlib.compress(plans_str, 1)
     print("zlib size", sys.getsizeof(pickle.dumps(compressed)) / 1024)
 
-    compressor = Compressor()
-    plans = [compressor.compress(p) for p in plans]
-    print("compressor size", sys.getsizeof(pickle.dumps({"p": plans, "c": compressor})) / 1024)
-
-    plans_str = "\n".join(plans).encode("utf-8")
-    print("compressor zlib size", sys.getsizeof(pickle.dumps({"p": zlib.compress(plans_str, 1), "c": compressor})) / 1024)
+    vocab = PlanVocabulary()
+    plans = [vocab.encode(p) for p in plans]
+    print("encoded size", sys.getsizeof(pickle.dumps(plans)) / 1024)
 
 
     # now = Time.now()
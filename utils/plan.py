@@ -0,0 +1,60 @@
+import re
+from functools import cached_property, lru_cache
+
+from utils.plan_codec import EncodedPlan
+
+RELATION_RE = re.compile(r"(<|>) (.*?) \[")
+ENTITY_RE = re.compile(r"ENT_\S+?_ENT")
+PARENS = {"[", "]"}
+DIRECTIONS = {"<", ">"}
+
+
+def word_tag(word: str):
+    # Feature tag of a plan word: Structure, Direction, Entity or Relation
+    return "S" if word in PARENS else ("D" if word in DIRECTIONS else ("E" if word[:4] == "ENT_" else "R"))
+
+
+class Plan(str):
+    # A plan string, parsed once. Plans are strings, equal to and hashed as their text, so they can be passed
+    # wherever a plan string is, and all the experts and feature extractors given the plan share its parse.
+    # Relations and sentences are parsed on creation, the rest on first access.
+
+    def __new__(cls, text: str):
+        plan = super().__new__(cls, text)
+        parts = text.split(".")
+        if len(parts) == 1:
+            plan.sentences = (plan,)
+            plan.relations = tuple(RELATION_RE.findall(text))
+        else:
+            plan.sentences = tuple(parse_sentence(s) for s in parts)
+            plan.relations = tuple(r for s in plan.sentences for r in s.relations)
+        return plan
+
+    @cached_property
+    def directions(self):
+        return tuple(d for d, r in self.relations)
+
+    @cached_property
+    def entities(self):
+        return tuple(ENTITY_RE.findall(self))
+
+    @cached_property
+    def words(self):
+        return tuple(self.split(" "))
+
+    @cached_property
+    def tags(self):
+        return tuple(word_tag(w) for w in self.words)
+
+
+@lru_cache(maxsize=100000)
+def parse_sentence(text: str):
+    # The plans of a graph share most of their sentences
+    return Plan(text)
+
+
+def parse_plan(plan):
+    # Encoded plans are already parsed to tokens, and are kept as they are
+    if isinstance(plan, (Plan, EncodedPlan)) or plan is None:
+        return plan
+    return Plan(plan)
@@ -0,0 +1,135 @@
+import re
+import uuid
+from array import array
+from typing import List, Tuple
+from weakref import WeakValueDictionary
+
+# A relation with its direction, an entity or any other word, a closing bracket, a sentence break, or whitespace.
+# Whitespace is kept as tokens, so decoding gives back the exact plan string.
+TOKEN_RE = re.compile(r"[<>] .*? \[|\]|\.|\s+|[^\s\]]+")
+RELATION_RE = re.compile(r"(<|>) (.*?) \[")
+
+VOCABULARIES = WeakValueDictionary()  # Vocabularies of this process by key
+
+
+class PlanVocabulary:
+    # Token ids, shared by all the plans of a corpus. A vocabulary is pickled as its key and tokens, once per pickle
+    # however many plans refer to it, and unpickled as the vocabulary of this process with the same key.
+    def __init__(self, key=None):
+        self.key = key or uuid.uuid4().hex
+        VOCABULARIES[self.key] = self
+        self.tokens = []
+        self.ids = {}
+        self.relations = []  # (direction, relation) per token id, or None if not a relation
+        self.break_id = self.token_id(".")
+
+    def token_id(self, token: str):
+        if token not in self.ids:
+            self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+            match = RELATION_RE.fullmatch(token)
+            self.relations.append(match.groups() if match else None)
+        return self.ids[token]
+
+    def typecode(self):
+        return "H" if len(self.tokens) <= 2 ** 16 else "I"
+
+    def encode(self, plan: str):
+        ids = [self.token_id(t) for t in TOKEN_RE.findall(plan)]
+        return EncodedPlan(self, array(self.typecode(), ids))
+
+    def decode(self, tokens):
+        return "".join([self.tokens[t] for t in tokens])
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __reduce__(self):
+        return vocabulary, (self.key, self.tokens)
+
+
+def vocabulary(key: str, tokens: List[str]):
+    # The vocabulary with the key, with the tokens it lacks added. Vocabularies only grow, so the tokens of two copies
+    # of a vocabulary are a prefix of one another, unless both grew after pickling. Then the tokens get a new one.
+    vocab = VOCABULARIES.get(key)
+    if vocab is None:
+        vocab = PlanVocabulary(key)
+    elif vocab.tokens[:len(tokens)] != tokens[:len(vocab.tokens)]:
+        vocab = PlanVocabulary()
+    for token in tokens[len(vocab.tokens):]:
+        vocab.token_id(token)
+    return vocab
+
+
+class EncodedPlan:
+    # A plan as an array of token ids. Plans of the same vocabulary are compared by their ids, and plans of
+    # different vocabularies by their tokens. Plans are pickled as their ids and vocabulary, which unpickles as the
+    # vocabulary the plan was encoded with, so the ids keep their meaning.
+    __slots__ = ("vocab", "tokens", "hash")
+
+    def __init__(self, vocab: PlanVocabulary, tokens: array):
+        self.vocab = vocab
+        self.tokens = tokens
+        self.hash = None
+
+    def __reduce__(self):
+        return EncodedPlan, (self.vocab, self.tokens)
+
+    def __eq__(self, other):
+        if not isinstance(other, EncodedPlan):
+            return NotImplemented
+        if self.vocab is other.vocab:
+            return self.tokens == other.tokens
+        return self.words() == other.words()
+
+    def __lt__(self, other):
+        return self.words() < other.words()
+
+    def __hash__(self):
+        # Not pickled, as string hashes are salted per process
+        if self.hash is None:
+            self.hash = hash(self.words())
+        return self.hash
+
+    def words(self):
+        tokens = self.vocab.tokens
+        return tuple([tokens[t] for t in self.tokens])
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __str__(self):
+        return self.vocab.decode(self.tokens)
+
+    def __repr__(self):
+        return "EncodedPlan(" + repr(str(self)) + ")"
+
+    def relations(self) -> List[Tuple[str, str]]:
+        relations = self.vocab.relations
+        return [relations[t] for t in self.tokens if relations[t] is not None]
+
+    def sentences(self) -> List["EncodedPlan"]:
+        sentences = []
+        start = 0
+        for i, t in enumerate(self.tokens):
+            if t == self.vocab.break_id:
+                sentences.append(EncodedPlan(self.vocab, self.tokens[start:i]))
+                start = i + 1
+        sentences.append(EncodedPlan(self.vocab, self.tokens[start:]))
+        return sentences
+
+
+PLAN_VOCABULARY = PlanVocabulary()
+
+
+def encode(plan, vocab: PlanVocabulary = PLAN_VOCABULARY):
+    if isinstance(plan, EncodedPlan) or plan is None:
+        return plan
+    return vocab.encode(plan)
+
+
+def decode(plan):
+    # Plan strings are passed through, so this can be applied to plans of either form
+    if isinstance(plan, EncodedPlan):
+        return str(plan)
+    return plan
@@ -0,0 +1,39 @@
+import threading
+from itertools import islice
+from math import exp
+
+from utils.graph import Graph, PlanCache
+
+
+class PlanSession:
+    # Plans of graphs edited a triple at a time, kept between requests. Sub-plans are cached by their triples,
+    # so after adding a triple only the sub-graphs including it are planned, and after removing one nothing new
+    # is planned. An edit changes every plan of the graph, so plans are not cached, but scored in batches.
+    def __init__(self, planner, max_sub_plans=200000, batch_size=10000):
+        self.planner = planner
+        self.max_sub_plans = max_sub_plans
+        self.batch_size = batch_size
+
+        self.cache = PlanCache()
+        self.lock = threading.Lock()
+
+    def structure(self, g: Graph, full=True, budget=None):
+        if not full:
+            return g.plan_all()
+
+        with self.lock:
+            if len(self.cache.sub_plans) + len(self.cache.plans) > self.max_sub_plans:
+                self.cache = PlanCache()
+            return g.exhaustive_plan(cache=self.cache, budget=budget)
+
+    def scores(self, g: Graph, plans):
+        # Scores of the plans, as given by planner.score
+        plans = iter(plans)
+        scores = []
+        while True:
+            batch = list(islice(plans, self.batch_size))
+            if len(batch) == 0:
+                break
+            batch_scores = self.planner.scores([(g, p) for p in batch])
+            scores += [exp(s) for s in batch_scores] if self.planner.log_scored else list(batch_scores)
+        return scores
@@ -0,0 +1,170 @@
+import mmap
+import os
+import pickle
+from array import array
+from itertools import islice
+
+from utils.graph import Graph, fill_slots
+
+INDEX_FILE = "index.pickle"
+DATA_FILE = "plans.bin"
+
+
+MAPS = {}  # Data file path to its memory map, shared by the ranked plans unpickled in this process
+
+
+def mapped(path: str, size: int):
+    # A map of the data file of at least `size` bytes, mapping it again if it grew
+    mm = MAPS.get(path)
+    if mm is None or len(mm) < size:
+        if mm is not None:
+            close_map(mm)
+        with open(path, "rb") as f:
+            mm = MAPS[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mm
+
+
+def close_map(mm):
+    # A map ranked plans still read ids from can not be closed, and is unmapped once they are freed
+    try:
+        mm.close()
+    except BufferError:
+        pass
+
+
+class RankedPlans:
+    # Plans of a stored graph, in rank order. A plan is made from the structure by its linearization id on access,
+    # and filled with the slots' entities if given. Slices are views over the same ids.
+    # Ids read from a store keep their place in its data file, (path, ids offset, range of ids), so they are pickled
+    # as their place and mapped again when unpickled.
+    def __init__(self, structure, ids, slots=None, source=None):
+        self.structure = structure
+        self.ids = ids
+        self.slots = slots
+        self.source = source
+
+    def plan(self, i: int):
+        plan = self.structure.linearization(i)
+        return fill_slots(plan, self.slots) if self.slots is not None else plan
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            source = None
+            if self.source is not None:
+                path, offset, indexes = self.source
+                source = path, offset, indexes[k]
+            return RankedPlans(self.structure, self.ids[k], self.slots, source)
+        return self.plan(self.ids[k])
+
+    def __iter__(self):
+        return (self.plan(i) for i in self.ids)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getstate__(self):
+        # Memory-mapped ids can not be pickled, so only their place is
+        state = self.__dict__.copy()
+        state["ids"] = array("Q", self.ids) if self.source is None else None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.ids is None:
+            path, offset, indexes = self.source
+            size = indexes.start + 1 if indexes.step < 0 else indexes.stop
+            ids = memoryview(mapped(path, offset + size * 8))[offset:offset + size * 8].cast("Q")
+            self.ids = ids[indexes.start:indexes.stop if indexes.stop >= 0 else None:indexes.step]
+
+
+class PlanStore:
+    # Plan structures and ranked linearization ids per graph, in a directory.
+    # Structures are pickled and ids are 64 bit, appended to one data file that is memory-mapped for reading,
+    # so any number of processes can open the store read-only without loading it to memory.
+    def __init__(self, path: str, writable=False):
+        self.path = path
+        self.writable = writable
+        self.index = {}  # Graph key to (structure offset, ids offset, number of ids)
+        self.mm = None
+
+        if writable:
+            os.makedirs(path, exist_ok=True)
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                self.index = pickle.load(f)
+
+        self.open()
+
+    def open(self):
+        self.close()
+        data_path = os.path.join(self.path, DATA_FILE)
+        if os.path.exists(data_path) and os.path.getsize(data_path) > 0:
+            with open(data_path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def key(g: Graph):
+        return g.unique_key()
+
+    def __contains__(self, g: Graph):
+        return self.key(g) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, g: Graph, slots=None):
+        structure_offset, ids_offset, size = self.index[self.key(g)]
+        if self.mm is None or len(self.mm) < ids_offset + size * 8:
+            self.open()  # Graphs were put after the data file was mapped
+        structure = pickle.loads(self.mm[structure_offset:ids_offset])
+        ids = memoryview(self.mm)[ids_offset:ids_offset + size * 8].cast("Q")
+        data_path = os.path.abspath(os.path.join(self.path, DATA_FILE))
+        return RankedPlans(structure, ids, slots, (data_path, ids_offset, range(size)))
+
+    def put(self, g: Graph, structure, ids, slots=None):
+        # Returns the ranked plans, as they would be read after the store is flushed
+        assert self.writable, "PlanStore is opened read-only"
+
+        with open(os.path.join(self.path, DATA_FILE), "ab") as f:
+            structure_offset = f.tell()
+            f.write(pickle.dumps(structure))
+            f.write(bytes(-f.tell() % 8))  # Aligns the ids
+            ids_offset = f.tell()
+            f.write(array("Q", ids).tobytes())
+
+        self.index[self.key(g)] = (structure_offset, ids_offset, len(ids))
+        return RankedPlans(structure, array("Q", ids), slots)
+
+    def flush(self):
+        # Makes the new graphs readable, by this store and by stores opened after it
+        assert self.writable, "PlanStore is opened read-only"
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + ".tmp", "wb") as f:
+            pickle.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+        self.open()
+
+    def close(self):
+        if self.mm is not None:
+            close_map(self.mm)
+            self.mm = None
+
+
+def ranked_ids(structure, score_batch, batch_size=10000):
+    # Linearization ids of the structure, ordered from the best scoring plan
+    plans = structure.iter_linearizations()
+    id_scores = []
+    while True:
+        batch = list(islice(plans, batch_size))
+        if len(batch) == 0:
+            break
+        id_scores += zip(range(len(id_scores), len(id_scores) + len(batch)), score_batch(batch))
+
+    return [i for i, s in sorted(id_scores, key=lambda a: a[1], reverse=True)]
@@ -0,0 +1,28 @@
+from utils.budget import PlanBudget
+from utils.graph import Graph
+
+STAR = Graph([("center", "r" + str(i % 2), "leaf" + str(i)) for i in range(5)])
+
+
+def test_limit_within_budget():
+    structure = STAR.exhaustive_plan()
+    budget = PlanBudget(seconds=60, plans=structure.count()).start()
+    assert list(budget.limit(structure)) == structure.linearizations()
+    assert budget.degraded == []
+
+
+def test_limit_samples_over_plans_budget():
+    structure = STAR.exhaustive_plan()
+    budget = PlanBudget(plans=10).start()
+    plans = list(budget.limit(structure))
+    assert len(set(plans)) == 10 and set(plans) <= set(structure.linearizations())
+    assert budget.degraded == ["plans: sampled 10 plans"]
+
+
+def test_limit_stops_out_of_time():
+    structure = STAR.exhaustive_plan()
+    assert structure.count() > 1000
+    budget = PlanBudget(seconds=0).start()
+    plans = list(budget.limit(structure))
+    assert plans == structure.linearizations()[:1000]
+    assert budget.degraded == ["time: stopped after 1000 plans"]
@@ -0,0 +1,38 @@
+import pickle
+
+from utils.compressed_plans import CompressedPlans
+
+
+def test_plans_are_kept_in_blocks():
+    plans = ["plan " + str(i) for i in range(50)]
+    compressed = CompressedPlans(plans, block_size=8)
+    assert len(compressed.blocks) == 7
+    assert len(compressed) == 50 and bool(compressed)
+    assert list(compressed) == plans
+    assert [compressed[i] for i in range(-50, 50)] == plans + plans
+    assert not CompressedPlans([])
+
+
+def test_slices_are_views():
+    plans = ["plan " + str(i) for i in range(50)]
+    compressed = CompressedPlans(plans, block_size=8)
+    for k in [slice(3, 20), slice(-10, None), slice(30, 10), slice(None, None, 3), slice(40, 5, -4)]:
+        assert list(compressed[k]) == plans[k]
+
+    view = compressed[5:45][10:30]
+    assert view.blocks is compressed.blocks
+    assert list(view) == plans[15:35] and view[-1] == plans[34]
+    try:
+        view[20]
+        assert False
+    except IndexError:
+        pass
+
+
+def test_pickle_drops_inflated_block():
+    plans = ["plan " + str(i) for i in range(50)]
+    view = CompressedPlans(plans, block_size=8)[10:20]
+    assert view[0] == plans[10]
+    unpickled = pickle.loads(pickle.dumps(view))
+    assert unpickled.cache == [None]
+    assert list(unpickled) == plans[10:20]
@@ -0,0 +1,106 @@
+import random
+import time
+
+from utils.graph import Graph, shards
+
+
+def test_duplicate_triples_are_one_edge():
+    duplicated = Graph([("A", "r", "B"), ("A", "r", "B"), ("A", "s", "C")])
+    plans = duplicated.exhaustive_plan().linearizations()
+
+    assert plans == Graph([("A", "r", "B"), ("A", "s", "C")]).exhaustive_plan().linearizations()
+    for plan in plans:
+        assert plan.count("> s [") + plan.count("< s [") == 1
+        assert plan.count("> r [") + plan.count("< r [") == 1
+
+
+def relabeled(rdfs, seed):
+    rng = random.Random(seed)
+    nodes = list(dict.fromkeys(n for s, r, o in rdfs for n in (s, o)))
+    names = dict(zip(nodes, rng.sample(["N" + str(i) for i in range(len(nodes))], len(nodes))))
+    rdfs = [(names[s], r, names[o]) for s, r, o in rdfs]
+    rng.shuffle(rdfs)
+    return rdfs
+
+
+def test_canonical_is_shared_by_isomorphic_graphs():
+    rng = random.Random(0)
+    for i in range(300):
+        nodes = ["n" + str(j) for j in range(rng.randint(1, 6))]
+        rdfs = list(dict.fromkeys((rng.choice(nodes), rng.choice("ab"), rng.choice(nodes))
+                                  for _ in range(rng.randint(1, 7))))
+        graph, slots = Graph(rdfs).canonical()
+        other, _ = Graph(relabeled(rdfs, i)).canonical()
+        assert graph == other
+
+        # Filling the slots gives back the graph
+        filled = [(slots[int(s[4:])], r, slots[int(o[4:])]) for s, r, o in graph.as_rdf()]
+        assert sorted(filled) == sorted(rdfs)
+
+
+def test_canonical_large_star():
+    star = [("center", "r", "leaf" + str(i)) for i in range(30)]
+    start = time.perf_counter()
+    graph, slots = Graph(star).canonical()
+    assert time.perf_counter() - start < 1
+    assert graph == Graph(relabeled(star, 0)).canonical()[0]
+
+
+def test_canonical_falls_back_to_own_order():
+    spider = [("center", "r", "a" + str(i)) for i in range(4)] + [("a" + str(i), "s", "b" + str(i)) for i in range(4)]
+    graph, slots = Graph(spider).compact().canonical(max_leaves=1)
+    filled = [(slots[int(s[4:])], r, slots[int(o[4:])]) for s, r, o in graph.as_rdf()]
+    assert sorted(filled) == sorted(spider)
+
+
+def test_cycle_plans_express_every_triple():
+    triangle = [("A", "r", "B"), ("B", "s", "C"), ("C", "t", "A")]
+    plans = Graph(triangle).plan_all().linearizations()
+    assert len(plans) > 0
+    for plan in plans:
+        for _, r, _ in triangle:
+            assert plan.count("> " + r + " [") + plan.count("< " + r + " [") == 1
+
+
+def plan_structures():
+    yield Graph([("A", "r", "B")]).exhaustive_plan()
+    yield Graph([("A", "r", "B"), ("A", "r", "C"), ("A", "s", "D")]).exhaustive_plan()  # Swappable leaves
+    yield Graph([("A", "r", "B"), ("B", "s", "C"), ("C", "t", "D"), ("B", "u", "E")]).exhaustive_plan()
+    yield Graph([("A", "r", "B"), ("A", "s", "B"), ("B", "t", "C")]).exhaustive_plan()  # Traversed
+    yield Graph([("A", "r", "B"), ("B", "s", "C"), ("C", "t", "A")]).compact().traverse_all()  # A LinearNode
+
+
+def test_indexed_linearizations():
+    for structure in plan_structures():
+        plans = structure.linearizations()
+        assert structure.count() == len(plans)
+        assert [structure.linearization(i) for i in range(len(plans))] == plans
+        assert list(structure.iter_linearizations()) == plans
+        assert set(structure.sample(min(5, len(plans)))) <= set(plans)
+
+
+def test_linearization_out_of_range():
+    structure = Graph([("A", "r", "B")]).exhaustive_plan()
+    for i in [-1, structure.count()]:
+        try:
+            structure.linearization(i)
+            assert False
+        except IndexError:
+            pass
+
+
+def test_shards_split_linearizations():
+    for structure in plan_structures():
+        for amount in [1, 2, 3, 7, 100]:
+            parts = shards(structure, amount)
+            assert len(parts) <= amount
+            assert [l for p in parts for l in p.linearizations()] == structure.linearizations()
+
+
+def test_large_star_is_indexed_without_enumerating():
+    star = Graph([("center", "r" + str(i % 3), "leaf" + str(i)) for i in range(8)]).exhaustive_plan()
+    assert star.count() > 10 ** 8
+    last = star.linearization(star.count() - 1)
+    assert all(last.count("ENT_LEAF" + str(i) + "_ENT") == 1 for i in range(8))
+    assert len(star.sample(100)) == 100
+    assert len(shards(star, 8)) == 8
@@ -0,0 +1,67 @@
+import pickle
+
+from scorer.scorer import get_relations, get_sentences
+from utils.graph import Graph
+from utils.plan_codec import PLAN_VOCABULARY, VOCABULARIES, PlanVocabulary, decode, encode
+
+
+def test_round_trip():
+    plans = Graph([("A", "r", "B"), ("B", "s t", "C"), ("A", "u", "D")]).exhaustive_plan().linearizations()
+    plans += ["", "  ENT_A_ENT  > r [ ENT_B_ENT ] . ", "ENT_A_B_ENT < is part of [ENT_C_ENT]"]
+    vocab = PlanVocabulary()
+    for plan in plans:
+        encoded = encode(plan, vocab)
+        assert str(encoded) == decode(encoded) == plan
+        assert decode(plan) == plan and encode(encoded) is encoded
+
+
+def test_relations_and_sentences_match_strings():
+    plan = "ENT_A_ENT > r [ ENT_B_ENT < s [ ENT_C_ENT ] ] . ENT_C_ENT > is part of [ ENT_D_ENT ]"
+    encoded = encode(plan, PlanVocabulary())
+    assert get_relations(encoded) == get_relations(plan)
+    assert [str(s) for s in get_sentences(encoded)] == get_sentences(plan)
+
+
+def test_equal_across_vocabularies():
+    plan = "ENT_A_ENT > r [ ENT_B_ENT ]"
+    first, second = encode(plan, PlanVocabulary()), encode("ENT_X_ENT " + plan, PlanVocabulary())
+    second = encode(plan, second.vocab)
+    assert first == second and hash(first) == hash(second)
+    assert first != encode(plan + " . ENT_B_ENT", first.vocab)
+
+
+def test_pickle_keeps_ids_and_vocabulary():
+    vocab = PlanVocabulary()
+    for i in range(1000):
+        vocab.token_id("ENT_" + str(i) + "_ENT")
+    plans = [encode("ENT_" + str(i) + "_ENT > r [ ENT_" + str(i + 1) + "_ENT ]", vocab) for i in range(100)]
+    shared = len(PLAN_VOCABULARY)
+
+    data = pickle.dumps(plans)
+    assert data.count(b"ENT_5_ENT") == 1  # The vocabulary, once, and the plans' ids
+    assert b"ENT_5_ENT > r [" not in data
+    unpickled = pickle.loads(data)
+    assert all(p.vocab is vocab for p in unpickled)
+    assert [p.tokens for p in unpickled] == [p.tokens for p in plans]
+    assert len(PLAN_VOCABULARY) == shared
+
+
+def test_unpickled_vocabulary_keeps_ids():
+    vocab = PlanVocabulary()
+    plan = encode("ENT_A_ENT > r [ ENT_B_ENT ]", vocab)
+    data = pickle.dumps(plan)
+
+    # Out of this process, the vocabulary is unpickled as a new one with the same key
+    del VOCABULARIES[vocab.key]
+    unpickled = pickle.loads(data)
+    assert unpickled.vocab is not vocab and unpickled.vocab.key == vocab.key
+    assert unpickled.tokens == plan.tokens and str(unpickled) == str(plan)
+
+    # A copy of the vocabulary that grew is extended, and one that grew apart is not used
+    encode("ENT_C_ENT", vocab)
+    assert pickle.loads(pickle.dumps(vocab)) is unpickled.vocab
+    assert unpickled.vocab.tokens == vocab.tokens
+    encode("ENT_D_ENT", vocab)
+    encode("ENT_E_ENT", unpickled.vocab)
+    apart = pickle.loads(pickle.dumps(vocab))
+    assert apart is not unpickled.vocab and apart.tokens == vocab.tokens
@@ -0,0 +1,58 @@
+import pickle
+
+from utils.graph import Graph
+from utils.plan_store import PlanStore, ranked_ids
+
+
+def stored(path):
+    g = Graph([("A", "r", "B"), ("B", "s", "C"), ("A", "t", "D")])
+    structure = g.exhaustive_plan()
+    ids = ranked_ids(structure, lambda batch: [len(p) for p in batch], batch_size=7)
+
+    store = PlanStore(path, writable=True)
+    store.put(g, structure, ids)
+    store.flush()
+    return g, structure, ids
+
+
+def test_ranked_ids_order_plans_by_score():
+    g = Graph([("A", "r", "B"), ("B", "s", "C")])
+    structure = g.exhaustive_plan()
+    ids = ranked_ids(structure, lambda batch: [len(p) for p in batch], batch_size=3)
+
+    plans = [structure.linearization(i) for i in ids]
+    assert sorted(ids) == list(range(structure.count()))
+    assert [len(p) for p in plans] == sorted([len(p) for p in plans], reverse=True)
+
+
+def test_store_round_trip(tmp_path):
+    g, structure, ids = stored(str(tmp_path))
+
+    store = PlanStore(str(tmp_path))
+    assert g in store and len(store) == 1
+    plans = store.get(g)
+    assert list(plans) == [structure.linearization(i) for i in ids]
+    assert list(plans[2:9:3]) == [structure.linearization(i) for i in ids[2:9:3]]
+    assert list(plans[::-1]) == [structure.linearization(i) for i in reversed(ids)]
+    store.close()
+
+
+def test_stored_plans_pickle_their_place(tmp_path):
+    g, structure, ids = stored(str(tmp_path))
+    plans = PlanStore(str(tmp_path)).get(g)
+
+    for view in [plans, plans[5:], plans[10:2:-2], plans[3:3]]:
+        assert list(pickle.loads(pickle.dumps(view))) == list(view)
+
+    # Only the place of the ids is pickled, not the ids
+    assert len(ids) > 50
+    assert len(pickle.dumps(plans)) - len(pickle.dumps(plans[:1])) < 16
+
+
+def test_open_closes_previous_map(tmp_path):
+    g, structure, ids = stored(str(tmp_path))
+    store = PlanStore(str(tmp_path))
+    first = store.mm
+    store.open()
+    assert first.closed
+    assert list(store.get(g)) == [structure.linearization(i) for i in ids]